@@ -0,0 +1,393 @@
+"""
+Local stand-ins for everything Lenny talks to, so its hot paths can be driven and timed offline:
+the challonge API and the sonicrat match feed as real HTTP servers, and a discord guild with its member cache,
+roles and a bot that takes commands from fake messages instead of the gateway.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+from discord.ext import commands
+from discord.ext.commands.view import StringView
+
+
+class FakeChallonge:
+    """
+    The parts of the challonge v1 API Lenny uses, serving tournaments from memory. latency is added to every request
+    and failure_rate of them get a 503, to see how the retries and the result outbox cope. fail() scripts the answers
+    to the next requests instead.
+    """
+    def __init__(self, tournaments=None, latency=0, failure_rate=0, seed=0):
+        # {tournament url: tournament as show_tournament returns it, with participants and matches}
+        self.tournaments = tournaments or {}
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        # {(method, route): number of requests}
+        self.requests = {}
+        # [(status, headers)] the next requests get instead of an answer
+        self.failures = []
+        self._next_id = 10 ** 6
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/v1/tournaments/{tournament}.json', self.show_tournament)
+        app.router.add_post('/v1/tournaments/{tournament}/participants.json', self.create_participant)
+        app.router.add_post('/v1/tournaments/{tournament}/participants/bulk_add.json', self.bulk_add_participants)
+        app.router.add_delete('/v1/tournaments/{tournament}/participants/{participant}.json', self.destroy_participant)
+        app.router.add_put('/v1/tournaments/{tournament}/matches/{match}.json', self.update_match)
+        app.middlewares.append(self._middleware)
+        return app
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        key = (request.method, route)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failures:
+            status, headers = self.failures.pop(0)
+            return web.json_response({'errors': [f'Failed with {status}']}, status=status, headers=headers)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            return web.json_response({'errors': ['Service unavailable']}, status=503)
+        if request.match_info.get('tournament') not in self.tournaments:
+            return web.json_response({'errors': ['Not found']}, status=404)
+        return await handler(request)
+
+    def fail(self, status, times=1, headers=None):
+        self.failures.extend([(status, headers)] * times)
+
+    def add_tournament(self, url):
+        self.tournaments[url] = {'id': len(self.tournaments) + 1, 'url': url, 'updated_at': self._timestamp(),
+                                 'participants': [], 'matches': []}
+        return self.tournaments[url]
+
+    def start(self, url):
+        """
+        Schedules every participant to play the next two in a random order, like make_bracket() does.
+        """
+        tournament = self.tournaments[url]
+        order = [p['participant']['id'] for p in tournament['participants']]
+        self.rng.shuffle(order)
+        matches = []
+        for i, participant_id in enumerate(order):
+            for opponent_id in (order[(i + 1) % len(order)], order[(i + 2) % len(order)]):
+                if opponent_id != participant_id:
+                    matches.append({'match': {'id': self._new_id(), 'state': 'open', 'winner_id': None,
+                                              'player1_id': participant_id, 'player2_id': opponent_id}})
+        tournament['matches'] = matches
+        self._changed(tournament)
+
+    async def show_tournament(self, request):
+        tournament = self.tournaments[request.match_info['tournament']]
+        data = {key: value for key, value in tournament.items() if key not in ('participants', 'matches')}
+        if request.query.get('include_participants') == '1':
+            data['participants'] = tournament['participants']
+        if request.query.get('include_matches') == '1':
+            data['matches'] = tournament['matches']
+        return web.json_response({'tournament': data})
+
+    async def create_participant(self, request):
+        tournament = self.tournaments[request.match_info['tournament']]
+        form = await request.post()
+        participant = self._add_participant(tournament, form['participant[name]'])
+        self._changed(tournament)
+        return web.json_response(participant)
+
+    async def bulk_add_participants(self, request):
+        tournament = self.tournaments[request.match_info['tournament']]
+        form = await request.post()
+        participants = [self._add_participant(tournament, name) for name in form.getall('participants[][name]')]
+        self._changed(tournament)
+        return web.json_response(participants)
+
+    async def destroy_participant(self, request):
+        tournament = self.tournaments[request.match_info['tournament']]
+        participant_id = int(request.match_info['participant'])
+        for i, participant in enumerate(tournament['participants']):
+            if participant['participant']['id'] == participant_id:
+                del tournament['participants'][i]
+                self._changed(tournament)
+                return web.json_response(participant)
+        return web.json_response({'errors': ['Participant not found']}, status=404)
+
+    async def update_match(self, request):
+        tournament = self.tournaments[request.match_info['tournament']]
+        match_id = int(request.match_info['match'])
+        form = await request.post()
+        for match in tournament['matches']:
+            match = match['match']
+            if match['id'] == match_id:
+                if 'match[winner_id]' in form:
+                    winner_id = int(form['match[winner_id]'])
+                    if winner_id not in (match['player1_id'], match['player2_id']):
+                        return web.json_response({'errors': ['Winner is not a participant of the match']}, status=422)
+                    match.update(winner_id=winner_id, state='complete', scores_csv=form.get('match[scores_csv]'))
+                self._changed(tournament)
+                return web.json_response({'match': match})
+        return web.json_response({'errors': ['Match not found']}, status=404)
+
+    def _add_participant(self, tournament, name):
+        participant = {'participant': {'id': self._new_id(), 'name': name}}
+        tournament['participants'].append(participant)
+        return participant
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def _changed(self, tournament):
+        tournament['updated_at'] = self._timestamp()
+
+    @staticmethod
+    def _timestamp():
+        # unique even for changes within the same second, the cache compares them for equality only
+        return f'{time.time():.6f}'
+
+
+class FakeSonicrat:
+    """
+    The MWW match history as one growing json list, streamed in chunks the way sonicrat sends it.
+    """
+    def __init__(self, matches=(), chunk_size=64 * 1024):
+        self.matches = []
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.bytes_sent = 0
+        # every match is encoded once, when it's added - encoding the whole history again would hold the GIL for long
+        self._encoded = []
+        self._body = None
+        self.append(matches)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/', self.history)
+        return app
+
+    def append(self, matches):
+        self.matches.extend(matches)
+        self._encoded.extend(json.dumps(match).encode() for match in matches)
+        self._body = None
+
+    async def history(self, request):
+        self.requests += 1
+        if self._body is None:
+            self._body = b'[' + b', '.join(self._encoded) + b']'
+        body = self._body
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+        for i in range(0, len(body), self.chunk_size):
+            await response.write(body[i:i + self.chunk_size])
+        await response.write_eof()
+        self.bytes_sent += len(body)
+        return response
+
+
+class Services:
+    """
+    Serves the fake HTTP services from a thread with an event loop of its own, so their work doesn't show up as
+    event loop lag of the bot being measured. Changes to their state go through call(), on that loop.
+    """
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+        self.loop = asyncio.new_event_loop()
+        self.runners = []
+        self._thread = threading.Thread(target=self.loop.run_forever, name='fake-services', daemon=True)
+        self._thread.start()
+
+    def serve(self, app):
+        """
+        Starts serving app on a free port, returns its base url.
+        """
+        async def start():
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, self.host, 0)
+            await site.start()
+            self.runners.append(runner)
+            return f'http://{self.host}:{site._server.sockets[0].getsockname()[1]}'
+        return asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+
+    def call(self, function, *args):
+        async def call():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def stop(self):
+        async def cleanup():
+            for runner in self.runners:
+                await runner.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class FakeRole:
+    def __init__(self, guild, role_id, name):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.mention = f'<@&{role_id}>'
+
+    async def delete(self, reason=None):
+        await self.guild.rest_call()
+        self.guild._roles.pop(self.id, None)
+        for member in self.guild.members.values():
+            if self in member.roles:
+                member.roles.remove(self)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMember:
+    def __init__(self, guild, discord_id, name, nick=None):
+        self.guild = guild
+        self.id = discord_id
+        self.name = name
+        self.nick = nick
+        self.discriminator = '0001'
+        self.mention = f'<@{discord_id}>'
+        self.roles = []
+        self.activity = None
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    async def add_roles(self, *roles, reason=None):
+        await self.guild.rest_call()
+        self.roles.extend(role for role in roles if role not in self.roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.guild.rest_call()
+        self.roles = [role for role in self.roles if role not in roles]
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+
+class FakeGuild:
+    """
+    A guild with a complete member cache. Everything that would be a discord REST call waits `latency` seconds.
+    """
+    def __init__(self, guild_id=1, latency=0):
+        self.id = guild_id
+        self.shard_id = 0
+        self.latency = latency
+        # {discord id: FakeMember}
+        self.members = {}
+        self._roles = {}
+        self._next_role_id = 9 * 10 ** 17
+        # what the member converter looks at when it has to ask discord
+        self._state = SimpleNamespace(member_cache_flags=SimpleNamespace(joined=False))
+        self.rest_calls = 0
+
+    async def rest_call(self):
+        self.rest_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def add_member(self, discord_id, name, nick=None):
+        self.members[discord_id] = FakeMember(self, discord_id, name, nick)
+        return self.members[discord_id]
+
+    def get_member(self, discord_id):
+        return self.members.get(discord_id)
+
+    def get_member_named(self, name):
+        for member in self.members.values():
+            if name in (member.name, member.nick, str(member)):
+                return member
+        return None
+
+    async def query_members(self, query=None, *, limit=5, user_ids=None, cache=True):
+        # the cache has everyone, asking discord wouldn't find anyone else
+        await self.rest_call()
+        return []
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    @property
+    def roles(self):
+        return list(self._roles.values())
+
+    async def create_role(self, name, mentionable=False, colour=None, reason=None):
+        await self.rest_call()
+        self._next_role_id += 1
+        role = FakeRole(self, self._next_role_id, name)
+        self._roles[role.id] = role
+        return role
+
+
+class FakeChannel:
+    def __init__(self, channel_id=1):
+        self.id = channel_id
+        self.sent = []
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, attachments=()):
+        self.content = content
+        self.author = author
+        self.guild = author.guild
+        self.channel = channel
+        self.attachments = list(attachments)
+        self.mentions = []
+        self._state = None
+
+
+class FakeContext(commands.Context):
+    """
+    A command context whose replies are collected instead of sent.
+    """
+    def __init__(self, **attrs):
+        super().__init__(**attrs)
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.rest_call()
+        self.channel.sent.append(content)
+        self.sent.append(content)
+
+
+class FakeBot(commands.Bot):
+    """
+    A bot that never connects. Commands are handed to it as FakeMessages with process(), failures are collected.
+    """
+    def __init__(self, owner_id=None, **kwargs):
+        super().__init__('>', owner_id=owner_id, **kwargs)
+        # [(command name, error)]
+        self.errors = []
+
+    async def get_context(self, message, *, cls=FakeContext):
+        view = StringView(message.content)
+        ctx = cls(prefix=None, view=view, bot=self, message=message)
+        if not view.skip_string(self.command_prefix):
+            return ctx
+        ctx.prefix = self.command_prefix
+        ctx.invoked_with = view.get_word()
+        ctx.command = self.all_commands.get(ctx.invoked_with)
+        return ctx
+
+    async def process(self, message):
+        """
+        Runs the command in the message the way the gateway would. Returns the context, with the replies in ctx.sent.
+        """
+        ctx = await self.get_context(message)
+        await self.invoke(ctx)
+        return ctx
+
+    async def on_command_error(self, ctx, error):
+        self.errors.append((ctx.command.qualified_name if ctx.command else ctx.invoked_with, error))
+
+    def _get_websocket(self, guild_id=None, *, shard_id=None):
+        # the member converter checks whether it's rate limited before asking discord
+        return SimpleNamespace(is_ratelimited=lambda: False)
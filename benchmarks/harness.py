@@ -0,0 +1,426 @@
+"""
+Replays a season of league traffic against the tournament cogs, with challonge, sonicrat and discord faked locally
+(see fakes.py), and reports the latency of every command, how fast new matches get ingested and reported, and how
+late the event loop got meanwhile.
+
+    python3 benchmarks/harness.py                                # a synthetic season, as fast as it goes
+    python3 benchmarks/harness.py --players 3000 --speed 86400 --discord-latency 0.05 --challonge-latency 0.2
+                                                                 # a simulated day per second, commands overlap
+    python3 benchmarks/harness.py record -o season/              # saves the live match feed and bracket
+    python3 benchmarks/harness.py --recorded season/             # replays them with the roster from >admin export
+
+A synthetic season starts with the registration: every player registers and the captains register their teams, all
+through the commands. Then the bracket is started and the matches of the season are played - they are added to the
+fake match feed as their time comes, the feed is parsed every --parse-interval and players look up teams and players.
+A recorded season needs bracket.json (show_tournament with participants and matches), feed.json (the sonicrat history)
+and roster.json (>admin export) in the directory. Its matches are spread over the season in the order of the feed.
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# tournament.py reads these when it's imported
+os.environ.setdefault('TESTING', '1')
+os.environ.setdefault('REGISTRATION_OPEN', '1')
+
+from challonge_client import ChallongeClient  # noqa: E402
+from fakes import FakeBot, FakeChallonge, FakeChannel, FakeGuild, FakeMessage, FakeSonicrat, Services  # noqa: E402
+from feed import MatchFeed  # noqa: E402
+from storage import JsonDB  # noqa: E402
+from synthetic import make_history, make_league  # noqa: E402
+import workers  # noqa: E402
+
+DAY = 24 * 3600
+TOURNAMENT = 'harness'
+OWNER_ID = 1
+
+
+class Season:
+    """
+    The timeline of a season, kind being command, matches, parse or start. Events can be added while it's replayed.
+    """
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        # heap of (simulated second, sequence number, kind, what)
+        self.events = []
+        self._added = 0
+
+    def add(self, at, kind, what=None):
+        heapq.heappush(self.events, (at, self._added, kind, what))
+        self._added += 1
+
+    def pop(self):
+        at, _, kind, what = heapq.heappop(self.events)
+        return at, kind, what
+
+
+def plan_registration(season, players, teams, days):
+    """
+    Everybody registers within the first `days`, the captains register their team once all of its players have.
+    """
+    registered_at = {}
+    for player in players:
+        registered_at[player.discord_id] = season.rng.uniform(0, days * DAY * 0.8)
+        season.add(registered_at[player.discord_id], 'command', (player.discord_id, f'>register {player.ingame_name}'))
+    for team in teams:
+        at = max(registered_at[discord_id] for discord_id in team.players) + season.rng.uniform(60, DAY * 0.2)
+        mentions = ' '.join(f'<@{discord_id}>' for discord_id in team.players if discord_id != team.captain)
+        season.add(at, 'command', (team.captain, f'>team register "{team.name}" {mentions}'))
+    season.add(days * DAY, 'start')
+
+
+def plan_season(season, players, team_names, start, days, parse_interval, lookups_per_day, nick_changes):
+    """
+    Parsing every parse_interval and lookups during the season. The matches themselves are added once the bracket exists.
+    """
+    end = start + days * DAY
+    at = start + parse_interval
+    while at <= end + parse_interval:
+        season.add(at, 'parse')
+        at += parse_interval
+    for _ in range(int(lookups_per_day * days)):
+        at = season.rng.uniform(start, end)
+        author = season.rng.choice(players).discord_id
+        kind = season.rng.random()
+        if kind < 0.45 and team_names:
+            command = f'>team {season.rng.choice(team_names)}'
+        elif kind < 0.9:
+            command = f'>player <@{season.rng.choice(players).discord_id}>'
+        elif team_names:
+            command = f'>listplayers {season.rng.choice(team_names)}'
+        else:
+            command = '>listplayers unteamed'
+        season.add(at, 'command', (author, command))
+    for player in season.rng.sample(players, min(nick_changes, len(players))):
+        season.add(season.rng.uniform(start, end), 'command', (player.discord_id, f'>changenick {player.ingame_name}_'))
+
+
+def spread_matches(season, history, start, days):
+    """
+    Spreads the matches evenly over the season in their order, an hour's worth at a time.
+    """
+    hours = max(1, int(days * 24))
+    per_hour = len(history) / hours
+    for hour in range(hours):
+        batch = history[int(hour * per_hour):int((hour + 1) * per_hour)]
+        if batch:
+            season.add(start + hour * 3600, 'matches', batch)
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.challonge = FakeChallonge(latency=args.challonge_latency, failure_rate=args.failure_rate, seed=args.seed)
+        self.sonicrat = FakeSonicrat()
+        self.guild = FakeGuild(latency=args.discord_latency)
+        self.channel = FakeChannel()
+        self.bot = None
+        self.cog = None
+        self.services = Services()
+        # {command name: [seconds]}
+        self.latencies = {}
+        self.parses = []
+        self.lags = []
+        self._parsing = None
+        self._pending = set()
+
+    async def start(self):
+        challonge_url = self.services.serve(self.challonge.app())
+        sonicrat_url = self.services.serve(self.sonicrat.app())
+        if self.args.workers:
+            workers.start()
+        self.bot = FakeBot(owner_id=OWNER_ID)
+        self.bot.tournaments = {'league': {'challonge_id': TOURNAMENT, 'prefix': ''}}
+        self.bot.challonge = ChallongeClient('harness', 'harness', base_url=f'{challonge_url}/v1/')
+        self.bot.match_feed = MatchFeed(f'{sonicrat_url}/api/', pool=self.bot.challonge.connector)
+        start = time.perf_counter()
+        self.bot.load_extension('tournament')
+        self.bot.load_extension('admin')
+        self.cog = self.bot.get_cog('Tournament')
+        await self.cog.ready.wait()
+        return time.perf_counter() - start
+
+    async def stop(self):
+        for name in list(self.bot.extensions):
+            self.bot.unload_extension(name)
+        await self.bot.match_feed.close()
+        await self.bot.challonge.close()
+        workers.stop()
+        self.services.stop()
+
+    async def command(self, author_id, content):
+        message = FakeMessage(content, self.guild.get_member(author_id), self.channel)
+        errors = len(self.bot.errors)
+        start = time.perf_counter()
+        ctx = await self.bot.process(message)
+        elapsed = time.perf_counter() - start
+        name = ctx.command.qualified_name if ctx.command else content.split()[0]
+        if ctx.invoked_subcommand is not None:
+            name = ctx.invoked_subcommand.qualified_name
+        self.latencies.setdefault(name, []).append(elapsed)
+        if len(self.bot.errors) > errors and self.args.verbose:
+            print(f'{content}: {self.bot.errors[-1][1]!r}', file=sys.stderr)
+
+    async def parse(self):
+        feed_size = len(self.sonicrat.matches)
+        sent = self.sonicrat.bytes_sent
+        start = time.perf_counter()
+        results = await self.cog.parse_played_matches()
+        self.parses.append({'seconds': time.perf_counter() - start, 'feed': feed_size, 'bytes': self.sonicrat.bytes_sent - sent,
+                            'found': sum(len(division_results) for division_results in results.values())})
+
+    def run(self, coroutine):
+        # with a speed, the events overlap the way they would live
+        if not self.args.speed:
+            return coroutine
+        task = asyncio.ensure_future(coroutine)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return None
+
+    async def measure_lag(self, interval=0.01):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lags.append(time.perf_counter() - start - interval)
+
+    async def settle(self):
+        # waits for the commands that are still running
+        if self._pending:
+            await asyncio.wait(self._pending)
+
+    async def replay(self, season, on_start=None):
+        lag = asyncio.ensure_future(self.measure_lag())
+        started = time.perf_counter()
+        try:
+            while season.events:
+                at, kind, what = season.pop()
+                if self.args.speed:
+                    delay = started + at / self.args.speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                if kind == 'command':
+                    waiting = self.run(self.command(*what))
+                elif kind == 'matches':
+                    self.services.call(self.sonicrat.append, what)
+                    waiting = None
+                elif kind == 'parse':
+                    # like the hourly task, a parse doesn't start while the last one is still running
+                    if self._parsing is not None and not self._parsing.done():
+                        continue
+                    self._parsing = asyncio.ensure_future(self.parse())
+                    waiting = None if self.args.speed else self._parsing
+                else:
+                    waiting = on_start(season) if on_start else None
+                if waiting is not None:
+                    await waiting
+                # back to back, the commands that don't wait for anything would never let the lag be measured
+                await asyncio.sleep(0)
+            await self.settle()
+            if self._parsing is not None:
+                await self._parsing
+            await self.parse()
+            replayed = time.perf_counter() - started
+            # whatever is still in the outboxes, without waiting for the delivery task
+            for division in self.cog.divisions.values():
+                for entry in division.outbox.entries.values():
+                    entry['next_attempt'] = 0
+                while division.outbox.due() and await division.outbox.deliver(division.bracket):
+                    pass
+            return replayed
+        finally:
+            lag.cancel()
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+
+def report(harness, loaded, replayed, season_days):
+    commands = {name: {'count': len(values), 'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95),
+                       'p99': percentile(values, 0.99), 'max': max(values)} for name, values in sorted(harness.latencies.items())}
+    parse_seconds = sum(parse['seconds'] for parse in harness.parses)
+    matches = len(harness.sonicrat.matches)
+    outboxes = [division.outbox.counts() for division in harness.cog.divisions.values()]
+    completed = sum(1 for tournament in harness.challonge.tournaments.values()
+                    for match in tournament['matches'] if match['match'].get('winner_id') is not None)
+    return {
+        'startup_seconds': loaded,
+        'replay_seconds': replayed,
+        'simulated_days': season_days,
+        'commands': commands,
+        'command_errors': len(harness.bot.errors),
+        'ingestion': {'parses': len(harness.parses), 'matches': matches, 'parse_seconds': parse_seconds,
+                      'last_parse_seconds': harness.parses[-1]['seconds'] if harness.parses else 0,
+                      'feed_bytes': sum(parse['bytes'] for parse in harness.parses),
+                      'results_found': sum(parse['found'] for parse in harness.parses),
+                      'matches_per_second': sum(parse['feed'] for parse in harness.parses) / parse_seconds if parse_seconds else 0},
+        # sent entries are pruned from the outbox, what got through shows on challonge
+        'outbox': {status: sum(counts[status] for counts in outboxes) for status in ('pending', 'failed')},
+        'challonge_matches_completed': completed,
+        'challonge_requests': sum(harness.challonge.requests.values()),
+        'discord_rest_calls': harness.guild.rest_calls,
+        'event_loop_lag': {'p99': percentile(harness.lags, 0.99), 'max': max(harness.lags, default=0)},
+    }
+
+
+def print_report(result):
+    print(f"startup {result['startup_seconds'] * 1000:.0f} ms, {result['simulated_days']:.0f} simulated days replayed in {result['replay_seconds']:.1f} s")
+    print(f"\n  {'command':<20} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in result['commands'].items():
+        print(f"  {name:<20} {stats['count']:>7} {stats['p50'] * 1000:>9.2f} {stats['p95'] * 1000:>9.2f} "
+              f"{stats['p99'] * 1000:>9.2f} {stats['max'] * 1000:>9.2f}")
+    print(f"  {result['command_errors']} commands failed")
+    ingestion = result['ingestion']
+    print(f"\ningestion: {ingestion['parses']} parses of a feed growing to {ingestion['matches']} matches "
+          f"({ingestion['feed_bytes'] / 2 ** 20:.1f} MiB downloaded in total) took {ingestion['parse_seconds']:.2f} s, "
+          f"{ingestion['matches_per_second']:.0f} matches/s, the last one {ingestion['last_parse_seconds'] * 1000:.0f} ms")
+    outbox = result['outbox']
+    print(f"results: {ingestion['results_found']} found, {result['challonge_matches_completed']} matches completed on challonge, "
+          f"{outbox['pending']} still pending and {outbox['failed']} failed in the outbox")
+    print(f"requests: {result['challonge_requests']} to challonge, {result['discord_rest_calls']} to discord")
+    lag = result['event_loop_lag']
+    print(f"event loop lag: p99 {lag['p99'] * 1000:.1f} ms, max {lag['max'] * 1000:.1f} ms")
+
+
+async def synthetic_season(args):
+    players, teams = make_league(args.players, args.teams or max(2, args.players // 10), seed=args.seed)
+    harness = Harness(args)
+    harness.guild.add_member(OWNER_ID, 'owner')
+    for player in players:
+        harness.guild.add_member(player.discord_id, player.name)
+    harness.challonge.add_tournament(TOURNAMENT)
+    loaded = await harness.start()
+
+    season = Season(args.seed)
+    plan_registration(season, players, teams, args.registration_days)
+    start = args.registration_days * DAY
+    plan_season(season, players, [team.name for team in teams], start, args.days, args.parse_interval, args.lookups_per_day, args.nick_changes)
+
+    async def start_bracket(season):
+        # the matches can only be made up once the teams are on challonge
+        await harness.settle()
+        harness.services.call(harness.challonge.start, TOURNAMENT)
+        division = harness.cog.divisions['league']
+        history = make_history(division.players_db.db, division.teams_db.db, harness.challonge.tournaments[TOURNAMENT],
+                               args.matches or args.players * 10, seed=args.seed)
+        spread_matches(season, history, start, args.days)
+
+    try:
+        replayed = await harness.replay(season, start_bracket)
+        return report(harness, loaded, replayed, args.registration_days + args.days)
+    finally:
+        await harness.stop()
+
+
+async def recorded_season(args):
+    directory = args.recorded
+    with open(os.path.join(directory, 'bracket.json'), 'rb') as f:
+        bracket = ChallongeClient._unwrap(json.load(f))
+    with open(os.path.join(directory, 'feed.json'), 'rb') as f:
+        history = json.load(f)
+    # an export is in the format of the databases, challonge ids and all
+    with open(os.path.join(directory, 'roster.json'), 'rb') as f:
+        exported = json.load(f, object_hook=JsonDB._decoder)
+    players, teams = exported['players'], exported['teams']
+    # the databases are there before the cog loads, the same as after a real registration
+    JsonDB._write_atomic('playersDB.json', players)
+    JsonDB._write_atomic('teamsDB.json', teams)
+
+    harness = Harness(args)
+    harness.guild.add_member(OWNER_ID, 'owner')
+    for player in players:
+        harness.guild.add_member(player.discord_id, player.name)
+    harness.challonge.tournaments[TOURNAMENT] = bracket
+    loaded = await harness.start()
+
+    season = Season(args.seed)
+    spread_matches(season, history, 0, args.days)
+    plan_season(season, players, [team.name for team in teams], 0, args.days, args.parse_interval, args.lookups_per_day, args.nick_changes)
+    try:
+        replayed = await harness.replay(season)
+        return report(harness, loaded, replayed, args.days)
+    finally:
+        await harness.stop()
+
+
+async def record(args):
+    """
+    Saves the live match feed and, with CHALLONGE_API_TOKEN and --tournament, the challonge bracket.
+    """
+    os.makedirs(args.output, exist_ok=True)
+    match_feed = MatchFeed(args.feed_url)
+    try:
+        with open(os.path.join(args.output, 'feed.json'), 'wb') as f:
+            async for data in match_feed.batches():
+                f.write(data)
+    finally:
+        await match_feed.close()
+    if args.tournament:
+        client = ChallongeClient(args.challonge_user, os.environ['CHALLONGE_API_TOKEN'])
+        try:
+            bracket = await client.show_tournament(args.tournament, include_participants=1, include_matches=1)
+        finally:
+            await client.close()
+        with open(os.path.join(args.output, 'bracket.json'), 'w') as f:
+            json.dump({'tournament': bracket}, f)
+    print(f'Saved to {args.output}, add roster.json from >admin export to replay it.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', nargs='?', choices=('replay', 'record'), default='replay')
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--teams', type=int, help='default: players / 10')
+    parser.add_argument('--matches', type=int, help='MWW matches played during the season, default: players * 10')
+    parser.add_argument('--registration-days', type=float, default=7)
+    parser.add_argument('--days', type=float, default=28, help='length of the season')
+    parser.add_argument('--parse-interval', type=float, default=3600, help='simulated seconds between the parses')
+    parser.add_argument('--lookups-per-day', type=float, default=500)
+    parser.add_argument('--nick-changes', type=int, default=50)
+    parser.add_argument('--speed', type=float, default=0, help='simulated seconds per second, 0 runs the events one by one as fast as possible')
+    parser.add_argument('--challonge-latency', type=float, default=0, help='seconds added to every challonge request')
+    parser.add_argument('--discord-latency', type=float, default=0, help='seconds every discord REST call takes')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of challonge requests that fail with a 503')
+    parser.add_argument('--no-workers', dest='workers', action='store_false', help='parse and write on the event loop')
+    parser.add_argument('--recorded', help='directory with bracket.json, feed.json and roster.json to replay')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the failed commands')
+    parser.add_argument('-o', '--output', help='replay: save the results as json, record: the directory to save to')
+    parser.add_argument('--feed-url', default=MatchFeed.URL)
+    parser.add_argument('--tournament', help='record: the challonge tournament to save')
+    parser.add_argument('--challonge-user', default='theshishi')
+    args = parser.parse_args()
+
+    if args.action == 'record':
+        if not args.output:
+            parser.error('record needs -o <directory>')
+        asyncio.run(record(args))
+        return
+    if args.recorded:
+        args.recorded = os.path.abspath(args.recorded)
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            result = asyncio.run(recorded_season(args) if args.recorded else synthetic_season(args))
+        finally:
+            os.chdir(cwd)
+    print_report(result)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
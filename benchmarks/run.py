@@ -0,0 +1,198 @@
+"""
+Times Lenny's hot paths on synthetic leagues of several sizes and reports time and peak memory for each.
+
+    python3 benchmarks/run.py                             # default scales, prints a table
+    python3 benchmarks/run.py --scales 100 1000 -o a.json  # also saves the results
+    python3 benchmarks/run.py --compare a.json            # shows the change against results saved earlier
+
+Every scale N means N players, N / 10 teams and a match history of N matches.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# tournament.py reads these when it's imported
+os.environ.setdefault('TESTING', '1')
+os.environ.setdefault('REGISTRATION_OPEN', '1')
+
+from challonge_client import TournamentState  # noqa: E402
+from feed import JsonListStream  # noqa: E402
+from matching import MatchEngine  # noqa: E402
+from storage import JsonDB  # noqa: E402
+from synthetic import make_bracket, make_history, make_league  # noqa: E402
+
+PLAYER_INDEXES = ('discord_id', 'name', 'ingame_name')
+DEFAULT_SCALES = (100, 1000, 10000, 100000)
+FEED_CHUNK_SIZE = 64 * 1024
+
+
+def measure(function, repeat=1):
+    """
+    Returns (seconds per call, peak traced memory in bytes) of function().
+    Time and memory are measured in separate runs, tracemalloc would slow the timed one down.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    elapsed = (time.perf_counter() - start) / repeat
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_jsondb(players, teams):
+    JsonDB._write_atomic('playersDB.json', players)
+    JsonDB._write_atomic('teamsDB.json', teams)
+    results = {'jsondb.load': measure(lambda: JsonDB('playersDB', indexes=PLAYER_INDEXES))}
+    db = JsonDB('playersDB', indexes=PLAYER_INDEXES)
+    results['jsondb.save'] = measure(db.save)
+    journaled = JsonDB('playersDB', indexes=PLAYER_INDEXES, journal=True)
+
+    def change_one():
+        journaled.db[0].team = None if journaled.db[0].team else 'team0'
+        journaled.save()
+    results['jsondb.save_journal_one_change'] = measure(change_one, repeat=20)
+    return results
+
+
+def bench_find_first(players):
+    db = JsonDB('playersDB', indexes=PLAYER_INDEXES)
+    ids = [player.discord_id for player in random.Random(1).sample(players, min(1000, len(players)))]
+
+    def lookups():
+        for discord_id in ids:
+            db.find_first('discord_id', discord_id)
+    elapsed, peak = measure(lookups)
+    return {'find_first.indexed_per_lookup': (elapsed / len(ids), peak)}
+
+
+def bench_parser(players, teams, bracket, history):
+    players_db = JsonDB('playersDB', indexes=PLAYER_INDEXES)
+    teams_db = JsonDB('teamsDB', indexes=('name',))
+    state = TournamentState(bracket)
+    found = []
+
+    def parse():
+        engine = MatchEngine.from_databases(teams_db, players_db, state)
+        found[:] = list(engine.classify_all(history))
+    results = {'get_played_matches.parse': measure(parse)}
+    results['get_played_matches.parse'] += (len(found),)
+
+    # the whole feed as it comes from sonicrat, decoded at once vs. streamed in chunks
+    body = json.dumps(history).encode()
+
+    def decode_all():
+        engine = MatchEngine.from_databases(teams_db, players_db, state)
+        found[:] = list(engine.classify_all(json.loads(body)))
+    results['get_played_matches.decode_all'] = measure(decode_all) + (len(found),)
+
+    def stream():
+        engine = MatchEngine.from_databases(teams_db, players_db, state)
+        matches = JsonListStream()
+        found[:] = []
+        chunks = memoryview(body)
+        for i in range(0, len(body), FEED_CHUNK_SIZE):
+            found.extend(engine.classify_all(matches.feed(chunks[i:i + FEED_CHUNK_SIZE])))
+        found.extend(engine.classify_all(matches.feed(b'', final=True)))
+    results['get_played_matches.stream'] = measure(stream) + (len(found),)
+    return results
+
+
+def bench_list_players(players):
+    from fakes import FakeChannel, FakeContext, FakeGuild, FakeMessage
+    import tournament
+    cog = tournament.Tournament.__new__(tournament.Tournament)
+    division = tournament.Division('bench', 'bench', None)
+    division.load()
+    guild = FakeGuild()
+    for player in players:
+        guild.add_member(player.discord_id, player.name)
+    author = guild.add_member(1, 'bench')
+
+    def list_players():
+        ctx = FakeContext(prefix='>', message=FakeMessage('>listplayers', author, FakeChannel()))
+        ctx.division = division
+        asyncio.run(cog.list_players.callback(cog, ctx))
+    return {'list_players': measure(list_players)}
+
+
+def run_scale(n):
+    players, teams = make_league(n, max(2, n // 10))
+    bracket = make_bracket(teams)
+    history = make_history(players, teams, bracket, n)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            results.update(bench_jsondb(players, teams))
+            results.update(bench_find_first(players))
+            results.update(bench_parser(players, teams, bracket, history))
+            try:
+                results.update(bench_list_players(players))
+            except ImportError as e:
+                print(f'Skipping list_players: {e}', file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+    return {name: {'seconds': values[0], 'peak_bytes': values[1], **({'found': values[2]} if len(values) > 2 else {})}
+            for name, values in results.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(report, baseline=None):
+    print(f"commit {report['commit']}" + (f" vs. {baseline['commit']}" if baseline else ''))
+    for scale, results in report['scales'].items():
+        print(f'\n{scale} records')
+        for name, result in results.items():
+            line = f"  {name:<36} {result['seconds'] * 1000:>11.3f} ms {result['peak_bytes'] / 2 ** 20:>9.2f} MiB"
+            old = (baseline or {}).get('scales', {}).get(scale, {}).get(name)
+            if old and old['seconds']:
+                line += f"   time x{result['seconds'] / old['seconds']:.2f}"
+                if old['peak_bytes']:
+                    line += f", memory x{result['peak_bytes'] / old['peak_bytes']:.2f}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES)
+    parser.add_argument('-o', '--output', help='save the results as json')
+    parser.add_argument('--compare', help='results saved earlier to compare against')
+    args = parser.parse_args()
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0], 'scales': {}}
+    for n in args.scales:
+        report['scales'][str(n)] = run_scale(n)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Generators of synthetic leagues for the benchmarks: registered players and teams, a challonge bracket and a MWW
+(sonicrat) match history. Everything is generated from a seed, so the same arguments always give the same league.
+"""
+import random
+
+from storage import Player, Team
+
+TEAM_SIZE = 3
+
+
+def make_league(n_players, n_teams, seed=0):
+    """
+    Returns (players, teams). Teams get TEAM_SIZE players each while there are enough of them, the rest are unteamed.
+    """
+    rng = random.Random(seed)
+    players = [Player(f'discord{i}', ingame_name=f'wizard{i}', discord_id=10 ** 17 + i) for i in range(n_players)]
+    order = list(range(n_players))
+    rng.shuffle(order)
+    teams = []
+    for t in range(min(n_teams, n_players // TEAM_SIZE)):
+        members = [players[i] for i in order[t * TEAM_SIZE:(t + 1) * TEAM_SIZE]]
+        team = Team(f'team{t}', members[0].discord_id, *[member.discord_id for member in members[1:]],
+                    challonge_id=5000 + t, discord_role=9000 + t)
+        for member in members:
+            member.team = team.name
+        teams.append(team)
+    return players, teams
+
+
+def make_bracket(teams, seed=0, url='bench'):
+    """
+    Returns the tournament the way the challonge API does with include_participants=1 and include_matches=1.
+    Every team is scheduled to play two others.
+    """
+    rng = random.Random(seed)
+    participants = [{'participant': {'id': team.challonge_id, 'name': team.name}} for team in teams]
+    order = list(teams)
+    rng.shuffle(order)
+    matches = []
+    for i, team in enumerate(order):
+        for opponent in (order[(i + 1) % len(order)], order[(i + 2) % len(order)]):
+            if opponent is not team:
+                matches.append({'match': {'id': 700000 + len(matches), 'state': 'open',
+                                          'player1_id': team.challonge_id, 'player2_id': opponent.challonge_id}})
+    return {'id': 1, 'url': url, 'updated_at': '2022-01-01T00:00:00.000+00:00', 'participants': participants, 'matches': matches}
+
+
+def make_history(players, teams, bracket, k, league_share=0.05, seed=0):
+    """
+    Returns k MWW matches, about league_share of them played between two teams scheduled against each other.
+    The rest are pick-up games of random (mostly unregistered) nicks and other modes.
+    """
+    rng = random.Random(seed)
+    by_challonge_id = {team.challonge_id: team for team in teams}
+    nick_of = {player.discord_id: player.ingame_name for player in players}
+    scheduled = [(by_challonge_id[m['match']['player1_id']], by_challonge_id[m['match']['player2_id']]) for m in bracket['matches']]
+    history = []
+    for i in range(k):
+        if scheduled and rng.random() < league_share:
+            team1, team2 = rng.choice(scheduled)
+            lineup = [(nick_of[_id], 1) for _id in team1.players] + [(nick_of[_id], 2) for _id in team2.players]
+            mode = 'melee'
+        else:
+            size = rng.randint(1, 4)
+            lineup = [(f'pug{rng.randrange(10 * k + 10)}', side) for side in (1, 2) for _ in range(size)]
+            mode = rng.choice(('melee', 'melee', 'duel', 'training'))
+        history.append({'id': i + 1, 'mode': mode, 'winner': rng.choice((0, 1, 2, 2, 1)),
+                        'players': [{'Name': name, 'TeamID': side} for name, side in lineup]})
+    return history
@@ -1,10 +1,27 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+import tracemalloc
+
+import aiohttp
+import discord
 from discord.ext import commands
-import challonge
+
+from challonge_client import ChallongeError
+import metrics
+import roster
+from roles import RoleScheduler
+from storage import DuplicateKeyError, transaction
+from tournament import NotReady
 
 
 class Admin(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.profiler = None
+        self.memory_snapshot = None
 
     @commands.group(aliases=['a'], hidden=True)
     @commands.is_owner()
@@ -17,14 +34,30 @@ class Admin(commands.Cog):
         self.bot.reload_extension('admin')
         await ctx.send(f'Extensions successfully reloaded.')
 
+    async def _division(self, ctx):
+        # the tournament the command is for, picked the same way as for the tournament commands
+        t = self.bot.get_cog('Tournament')
+        division = t.division_for(ctx)
+        if division is None:
+            await ctx.send(f'{ctx.author.mention}, which tournament? Use `>in <tournament> admin ...`.')
+            return None
+        try:
+            await t.wait_until_ready()
+        except NotReady as e:
+            await ctx.send(f'{ctx.author.mention}, {e}')
+            return None
+        return division
+
     @admin.command()
     async def delete(self, ctx):
-        t = self.bot.get_cog('Tournament')
-        t.teams_db.db = []
-        t.teams_db.save()
-        t.players_db.db = []
-        t.players_db.save()
-        await ctx.send('Database deleted.')
+        division = await self._division(ctx)
+        if division is None:
+            return
+        with transaction(division.teams_db, division.players_db):
+            division.teams_db.clear()
+            division.players_db.clear()
+        division.responses.clear()
+        await ctx.send(f'Database of {division.name} deleted.')
 
     @admin.command(name='load')
     async def load_extension(self, ctx, name):
@@ -40,33 +73,210 @@ class Admin(commands.Cog):
             if cog_name == 'Tournament':
                 await cog.get_played_matches.__call__()
 
+    @admin.command(name='timeparse')
+    async def time_match_parsing(self, ctx):
+        t = self.bot.get_cog('Tournament')
+        stopwatch = metrics.Stopwatch()
+        start = time.perf_counter()
+        try:
+            results = await t.parse_played_matches(stopwatch)
+        except NotReady as e:
+            await ctx.send(f'{ctx.author.mention}, {e}')
+            return
+        total = time.perf_counter() - start
+        breakdown = '\n'.join(f'{stage:<12} {seconds * 1000:10.1f} ms' for stage, seconds in stopwatch.stages.items())
+        found = ', '.join(f'{name}: {len(division_results)}' for name, division_results in results.items())
+        await ctx.send(f'```\n{breakdown}\n{"total":<12} {total * 1000:10.1f} ms\n```New league matches queued for challonge - {found}.')
+
+    @admin.command(name='profile')
+    async def profile(self, ctx, seconds: int = 30, top: int = 40):
+        if self.profiler is not None:
+            await ctx.send('Profiling is already running.')
+            return
+        await ctx.send(f'Profiling for {seconds} seconds.')
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats('cumulative').print_stats(top)
+        self.profiler = None
+        await ctx.send(f'Top {top} functions by cumulative time:', file=discord.File(io.BytesIO(report.getvalue().encode()), 'profile.txt'))
+
+    @admin.command(name='memory')
+    async def memory(self, ctx, action='diff', top: int = 25):
+        """
+        >admin memory start - starts tracing allocations and takes the first snapshot
+        >admin memory diff - shows what has grown since the last snapshot and takes a new one
+        >admin memory stop - stops tracing
+        """
+        if action == 'start':
+            tracemalloc.start()
+            self.memory_snapshot = tracemalloc.take_snapshot()
+            await ctx.send('Memory tracing started.')
+        elif action == 'stop':
+            tracemalloc.stop()
+            self.memory_snapshot = None
+            await ctx.send('Memory tracing stopped.')
+        elif self.memory_snapshot is None:
+            await ctx.send('Start memory tracing first with `>admin memory start`.')
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            stats = snapshot.compare_to(self.memory_snapshot, 'lineno')[:top]
+            self.memory_snapshot = snapshot
+            current, peak = tracemalloc.get_traced_memory()
+            report = f'Traced memory: {current / 2 ** 20:.1f} MiB (peak {peak / 2 ** 20:.1f} MiB)\n\n' + '\n'.join(str(stat) for stat in stats)
+            await ctx.send(f'Top {top} memory changes:', file=discord.File(io.BytesIO(report.encode()), 'memory.txt'))
+
+    @admin.command(name='roles')
+    async def role_queue(self, ctx):
+        queues = self.bot.role_queues()
+        totals = ', '.join(f'{name}: {sum(queue.metrics[name] for queue in queues)}' for name in RoleScheduler.METRICS)
+        await ctx.send(f'Role queue depth: {sum(queue.queue_depth for queue in queues)} in {len(queues)} guilds\n{totals}')
+
+    @admin.command(name='outbox')
+    async def show_outbox(self, ctx, status='unsent'):
+        """
+        >admin outbox [pending|sent|failed|all] - the results waiting to be reported to challonge (pending and failed by default)
+        """
+        division = await self._division(ctx)
+        if division is None:
+            return
+        outbox = division.outbox
+        entries = [entry for entry in outbox.entries.values()
+                   if status == 'all' or entry['status'] == status or (status == 'unsent' and entry['status'] != 'sent')]
+        now = time.time()
+        lines = []
+        for entry in entries:
+            line = f'{entry["match_id"]}: {entry["winner"]} beat {entry["loser"]} - {entry["status"]}'
+            if entry['status'] == 'pending' and entry['attempts']:
+                line += f', {entry["attempts"]} failed attempts, next in {max(0, entry["next_attempt"] - now):.0f}s'
+            if entry['error']:
+                line += f' ({entry["error"]})'
+            lines.append(line)
+        counts = ', '.join(f'{name}: {count}' for name, count in outbox.counts().items())
+        t = self.bot.get_cog('Tournament')
+        for page in t._paginate(f'Outbox of {division.name} - {counts}', lines):
+            await ctx.send(page)
+
+    @admin.command(name='replay')
+    async def replay_outbox(self, ctx, *match_ids: int):
+        """
+        >admin replay [challonge match ids] - sends the failed results (or the given ones, whatever their status) to challonge again
+        """
+        division = await self._division(ctx)
+        if division is None:
+            return
+        replayed = division.outbox.replay(match_ids or None)
+        await ctx.send(f'{replayed} results of {division.name} queued for challonge again.')
+        if replayed:
+            delivered = await division.outbox.deliver(division.bracket)
+            await ctx.send(f'{delivered} of them delivered, see `>admin outbox` for the rest.')
+
     @admin.command(name='killteam')
     async def kill_team(self, ctx, team_name):
         t = self.bot.get_cog('Tournament')
+        division = await self._division(ctx)
+        if division is None:
+            return False
         try:
-            team = t.teams_db.find_first('name', team_name)
+            team = division.teams_db.find_first('name', team_name)
         except KeyError:
             await ctx.send(f"{ctx.author.mention}, team {team_name} doesn't exist.")
             return False
 
-        t.teams_db.db.remove(team)
-        # destroy the team in challonge - we need to log in for that
-        challonge.set_credentials('theshishi', self.bot.challonge_api_token)
-        challonge.participants.destroy(t.full_url, team.challonge_id)
-
         # delete the team from everyone's profiles
-        team_players = [t.players_db.find_first("discord_id", _id) for _id in team.players]
-        for player in team_players:
-            player.team = None
-            d_user = await commands.MemberConverter().convert(ctx, str(player.discord_id))
-            # destroy the role
-            for role in d_user.roles:
-                if role.id == team.discord_role:
-                    await role.delete(reason="Team unregistered.")
-        t.teams_db.save()
-        t.players_db.save()
+        team_players = [division.players_db.find_first("discord_id", _id) for _id in team.players]
+        with transaction(division.teams_db, division.players_db):
+            division.teams_db.remove(team)
+            for player in team_players:
+                player.team = None
+        division.responses.forget('player', *team.players)
+        division.responses.forget('team', team.name)
+
+        # destroy the team in challonge and its role
+        error = await t.disband_team(ctx.guild, division, team)
         await ctx.send(f"The team {team_name} has been unregistered.")
+        if error:
+            await ctx.send(error)
+
+    @admin.command(name='import')
+    async def import_roster(self, ctx):
+        """
+        >admin import - registers all the players and teams from the attached .json or .csv roster at once
+        """
+        division = await self._division(ctx)
+        if division is None:
+            return
+        if not ctx.message.attachments:
+            await ctx.send(f'{ctx.author.mention}, attach the roster as a .json or .csv file.')
+            return
+        # the roster is checked against the teams and players registered meanwhile too
+        async with division.registration:
+            await self._import_roster(ctx, division)
+
+    async def _import_roster(self, ctx, division):
+        start = time.perf_counter()
+        attachment = ctx.message.attachments[0]
+        try:
+            players, teams = roster.load(attachment.filename, await attachment.read())
+            members = roster.check(division, players, teams)
+        except roster.RosterError as e:
+            await ctx.send(f'Cannot import the roster: {e}')
+            return
+        t = self.bot.get_cog('Tournament')
+
+        # all the teams are added to challonge in one request, so a failure there leaves nothing behind
+        participant_ids = {}
+        if teams:
+            try:
+                participants = await division.bracket.bulk_add_participants([team.name for team in teams])
+            except (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await ctx.send(f'Cannot import the roster, adding the teams to Challonge failed: {e}')
+                return
+            participant_ids = {participant['name']: participant['id'] for participant in participants}
+        roles = []
+        try:
+            roles = await t.team_roles.create(ctx.guild, [team.name for team in teams], reason='Role for the league team.')
+            with transaction(division.teams_db, division.players_db):
+                for player in players:
+                    division.players_db.append(player)
+                for team, role in zip(teams, roles):
+                    team.challonge_id = participant_ids[team.name]
+                    team.discord_role = role.id
+                    for player in members[team.name]:
+                        player.team = team.name
+                    division.teams_db.append(team)
+        except BaseException as e:
+            # the databases have been rolled back, undo the rest too
+            await t.team_roles.delete(roles, reason='Roster import failed.')
+            await asyncio.gather(*[division.bracket.destroy_participant(_id) for _id in participant_ids.values()], return_exceptions=True)
+            if isinstance(e, (discord.HTTPException, DuplicateKeyError, KeyError)):
+                await ctx.send(f'Cannot import the roster: {e}')
+                return
+            raise
+        # registered players who joined a team from the roster have a cached answer without it
+        division.responses.forget('player', *[player.discord_id for team_players in members.values() for player in team_players])
+        division.responses.forget('team', *members)
+        await asyncio.gather(*[t.team_roles.assign(ctx.guild, role, [player.discord_id for player in members[team.name]], reason='Role for the league team.')
+                               for team, role in zip(teams, roles)])
+        await ctx.send(f'Imported {len(players)} players and {len(teams)} teams into {division.name} in {time.perf_counter() - start:.1f}s.')
 
+    @admin.command(name='export')
+    async def export_roster(self, ctx, file_format='json'):
+        """
+        >admin export [json|csv] - sends all the players and teams as a file that >admin import can read back
+        """
+        division = await self._division(ctx)
+        if division is None:
+            return
+        if file_format not in ('json', 'csv'):
+            await ctx.send(f'{ctx.author.mention}, the roster can be exported as json or csv.')
+            return
+        data = roster.dump(division.players_db.db, division.teams_db.db, file_format)
+        await ctx.send(f'Roster of {division.name}:', file=discord.File(io.BytesIO(data), f'{division.name}-roster.{file_format}'))
 
 
 def setup(bot):
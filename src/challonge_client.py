@@ -0,0 +1,239 @@
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import math
+import random
+import time
+
+import aiohttp
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ChallongeError(Exception):
+    def __init__(self, status, errors):
+        self.status = status
+        self.errors = errors
+        super().__init__(f'Challonge API error {status}: {errors}')
+
+
+class ChallongeClient:
+    """
+    Asynchronous client for the parts of the Challonge API Lenny uses.
+    All the requests go through one keep-alive connection pool, at most max_concurrency of them at once.
+    Rate limited (429), failing (5xx) and timed out requests are retried with an exponential backoff.
+    """
+    API_URL = 'https://api.challonge.com/v1/'
+
+    def __init__(self, username, api_key, base_url=API_URL, timeout=10, max_concurrency=4, retries=4, backoff=0.5):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.auth = aiohttp.BasicAuth(username, api_key)
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._semaphore = None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # the session has to be created inside of the running event loop, so it's done on the first request
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            # one connection more than the requests let through, for the match feed that shares the pool
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency + 1, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, auth=self.auth, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._session
+
+    def connector(self):
+        # the connection pool, for other clients to share - their own sessions keep the challonge credentials out
+        return self._get_session().connector
+
+    async def request(self, method, path, params=None, data=None):
+        session = self._get_session()
+        # creating things isn't idempotent, so POSTs are only retried when challonge refused them outright
+        idempotent = method != 'POST'
+        attempt = 0
+        while True:
+            attempt += 1
+            retry_after = None
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    async with session.request(method, f'{self.base_url}{path}.json', params=params, data=data) as response:
+                        status = response.status
+                        if response.status < 400:
+                            return self._unwrap(await response.json(content_type=None))
+                        if response.status == 429 or (response.status >= 500 and idempotent):
+                            retry_after = response.headers.get('Retry-After')
+                            error = ChallongeError(response.status, await response.text())
+                        else:
+                            raise ChallongeError(response.status, await self._errors(response))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not idempotent:
+                    raise
+                error = e
+            finally:
+                metrics.CHALLONGE_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method, status=status)
+            if attempt > self.retries:
+                raise error
+            delay = self._retry_after(retry_after)
+            if delay is None:
+                delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+            log.warning(f'Challonge {method} {path} failed ({error}), retrying in {delay:.1f}s.')
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after(value):
+        # Retry-After is either seconds or an HTTP date, anything else gets the usual backoff
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+            return max(seconds, 0) if math.isfinite(seconds) else None
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if retry_at is None:
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    @staticmethod
+    async def _errors(response):
+        try:
+            return (await response.json(content_type=None))['errors']
+        except (ValueError, KeyError, TypeError):
+            return await response.text()
+
+    # {"tournament": {...}} -> {...}, the same shape pychallonge used to return
+    @staticmethod
+    def _unwrap(data):
+        if isinstance(data, list):
+            return [ChallongeClient._unwrap(item) for item in data]
+        if isinstance(data, dict) and len(data) == 1:
+            inner = next(iter(data.values()))
+            if isinstance(inner, dict):
+                return inner
+        return data
+
+    @staticmethod
+    def _form(prefix, fields):
+        return {f'{prefix}[{key}]': str(value) for key, value in fields.items() if value is not None}
+
+    async def show_tournament(self, tournament, include_participants=0, include_matches=0):
+        params = {'include_participants': int(include_participants), 'include_matches': int(include_matches)}
+        return await self.request('GET', f'tournaments/{tournament}', params=params)
+
+    async def create_participant(self, tournament, name, **fields):
+        return await self.request('POST', f'tournaments/{tournament}/participants', data=self._form('participant', {'name': name, **fields}))
+
+    async def bulk_add_participants(self, tournament, names):
+        # all of them in one request, the form field repeats for every participant
+        data = [('participants[][name]', name) for name in names]
+        return await self.request('POST', f'tournaments/{tournament}/participants/bulk_add', data=data)
+
+    async def destroy_participant(self, tournament, participant_id):
+        return await self.request('DELETE', f'tournaments/{tournament}/participants/{participant_id}')
+
+    async def update_match(self, tournament, match_id, **fields):
+        return await self.request('PUT', f'tournaments/{tournament}/matches/{match_id}', data=self._form('match', fields))
+
+
+class TournamentState:
+    """
+    Read-only view of a challonge tournament with its participants and matches, unwrapped from the raw API dicts.
+    """
+    def __init__(self, data):
+        self.data = data
+        self.updated_at = data.get('updated_at')
+        # {participant id: participant}
+        self.participants = {p['participant']['id']: p['participant'] for p in data.get('participants', [])}
+        # {participant name: participant id}, the participants are named after the teams
+        self.participant_ids = {p['name']: p['id'] for p in self.participants.values()}
+        self.matches = [m['match'] for m in data.get('matches', [])]
+
+
+class TournamentCache:
+    """
+    Keeps the state of one challonge tournament around, so it doesn't have to be downloaded for every use.
+    The state is refreshed once it's older than ttl seconds or after it has been changed through the cache itself.
+    """
+    def __init__(self, client, tournament, ttl=300):
+        self.client = client
+        self.tournament = tournament
+        self.ttl = ttl
+        self.state = None
+        self.fetched_at = 0
+        self.stale = True
+        self._lock = None
+
+    async def get(self):
+        if self.state is None or self.stale or time.monotonic() - self.fetched_at > self.ttl:
+            await self.refresh()
+        return self.state
+
+    def invalidate(self):
+        self.stale = True
+
+    async def refresh(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.state is not None and not self.stale:
+                # the tournament alone is a small request - if it hasn't changed, neither have its participants and matches
+                summary = await self.client.show_tournament(self.tournament)
+                if summary.get('updated_at') == self.state.updated_at:
+                    self.fetched_at = time.monotonic()
+                    return self.state
+            # invalidations that come while downloading mark the new state stale again
+            self.stale = False
+            try:
+                self.state = TournamentState(await self.client.show_tournament(self.tournament, include_participants=1, include_matches=1))
+            except BaseException:
+                self.stale = True
+                raise
+            self.fetched_at = time.monotonic()
+            return self.state
+
+    async def create_participant(self, name, **fields):
+        try:
+            return await self.client.create_participant(self.tournament, name, **fields)
+        finally:
+            self.invalidate()
+
+    async def bulk_add_participants(self, names):
+        try:
+            return await self.client.bulk_add_participants(self.tournament, names)
+        finally:
+            self.invalidate()
+
+    async def destroy_participant(self, participant_id):
+        try:
+            return await self.client.destroy_participant(self.tournament, participant_id)
+        finally:
+            self.invalidate()
+
+    async def update_matches(self, updates):
+        """
+        Sends [(match id, fields)] concurrently through the client's pool, refreshing the state only once afterwards.
+        Returns the updated match or the exception it failed with for each of them.
+        """
+        try:
+            return await asyncio.gather(*[self.client.update_match(self.tournament, match_id, **fields) for match_id, fields in updates],
+                                        return_exceptions=True)
+        finally:
+            if updates:
+                self.invalidate()
@@ -0,0 +1,142 @@
+import codecs
+import json
+import re
+import time
+
+import aiohttp
+
+import metrics
+
+WHITESPACE = re.compile(r'\s*')
+
+
+class JsonListStream:
+    """
+    Decodes a json list that arrives in chunks, handing out its items as soon as each of them is complete.
+    Only the unfinished tail of the data is kept around, never the whole document.
+    """
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        # what comes next: '[' before the list, 'item' or ']' right after it opened, ',' or ']' after an item
+        self._expect = '['
+
+    # it goes back and forth to the worker process between the pieces of the feed, the decoders themselves don't pickle
+    def __getstate__(self):
+        return {'buffer': self._buffer, 'expect': self._expect, 'text': self._text.getstate()}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self._buffer = state['buffer']
+        self._expect = state['expect']
+        self._text.setstate(state['text'])
+
+    def feed(self, chunk, final=False):
+        """
+        Adds the next chunk of bytes and returns the list of items it has completed. Pass final=True with the last one.
+        """
+        buffer = self._buffer + self._text.decode(chunk, final)
+        items = []
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if self._expect == '[':
+                if char != '[':
+                    raise json.JSONDecodeError('Expecting a list', buffer, pos)
+                self._expect = 'item or ]'
+                pos += 1
+                continue
+            if self._expect == 'done':
+                raise json.JSONDecodeError('Extra data', buffer, pos)
+            if char == ']' and self._expect != 'item':
+                self._expect = 'done'
+                pos += 1
+                continue
+            if self._expect == ', or ]':
+                if char != ',':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                self._expect = 'item'
+                pos += 1
+                continue
+            try:
+                item, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                # the item isn't complete yet
+                break
+            # a number is only complete once something else follows it, '12' could be the start of '12.5e3'
+            if not final and char not in '{["' and (end == len(buffer) or buffer[end] not in ' \t\n\r,]'):
+                break
+            items.append(item)
+            self._expect = ', or ]'
+            pos = end
+        self._buffer = buffer[pos:]
+        if final and self._expect != 'done':
+            raise json.JSONDecodeError('Unterminated list', buffer, len(buffer))
+        return items
+
+
+class MatchFeed:
+    """
+    The MWW match history from sonicrat. It's one json list of every match ever played that keeps growing,
+    so it's streamed and decoded match by match as it downloads.
+    """
+    URL = 'http://mww.sonicrat.org/api/'
+
+    def __init__(self, url=URL, chunk_size=64 * 1024, timeout=60, pool=None):
+        """
+        pool: returns the aiohttp connector to share, e.g. ChallongeClient.connector. Without it the feed has its own.
+        """
+        self.url = url
+        self.chunk_size = chunk_size
+        # the whole history can take a while, only a stalled connection counts as timed out
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+        self.pool = pool
+        self._session = None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def batches(self, size=1024 * 1024):
+        """
+        Yields the raw feed in pieces of about `size` bytes, cut anywhere - JsonListStream puts the matches back together.
+        """
+        # a session of our own - the connections can be shared, the credentials of the other client aren't
+        if self._session is None or self._session.closed:
+            connector = self.pool() if self.pool is not None else None
+            self._session = aiohttp.ClientSession(connector=connector, connector_owner=connector is None, timeout=self.timeout)
+        total = 0
+        # only the time spent waiting for sonicrat, not what the consumer does with the batches in between
+        fetching = 0
+        try:
+            start = time.perf_counter()
+            async with self._session.get(self.url) as response:
+                response.raise_for_status()
+                fetching += time.perf_counter() - start
+                batch = []
+                batch_size = 0
+                while True:
+                    start = time.perf_counter()
+                    chunk = await response.content.read(self.chunk_size)
+                    fetching += time.perf_counter() - start
+                    if not chunk:
+                        break
+                    batch.append(chunk)
+                    batch_size += len(chunk)
+                    total += len(chunk)
+                    if batch_size >= size:
+                        yield b''.join(batch)
+                        batch = []
+                        batch_size = 0
+                if batch:
+                    yield b''.join(batch)
+        finally:
+            metrics.SONICRAT_FETCH_SECONDS.observe(fetching)
+        metrics.SONICRAT_FETCH_BYTES.set(total)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+
+from storage import JsonDB
+import workers
+
+
+class IngestState:
+    """
+    Remembers how far into the MWW match history we've got and which results have already been reported to challonge,
+    so every run only looks at the new matches and nothing is reported twice.
+    """
+    # fields of a MWW match that can serve as its increasing id, the first one present is used
+    MATCH_ID_KEYS = ('id', 'ID', 'MatchID', 'match_id')
+    # how many games waiting for their challonge match are kept, the oldest ones go first
+    WAITING_KEPT = 1000
+
+    def __init__(self, name='ingestState'):
+        self.filename = f'{name}.json'
+        # highest match id processed so far
+        self.watermark = None
+        # fingerprints of the MWW matches that have been reported
+        self.reported = set()
+        # ids of the challonge matches that have been reported
+        self.reported_matches = set()
+        # {fingerprint: MWW match} of the games between two teams that challonge had no match for yet, in the order found
+        self.waiting = {}
+        self._next_watermark = None
+        self._next_waiting = {}
+        try:
+            with open(self.filename, 'r') as state:
+                data = json.load(state)
+            self.watermark = data['watermark']
+            self.reported = set(data['reported'])
+            self.reported_matches = set(data['reported_matches'])
+            self.waiting = {self.fingerprint(match): match for match in data.get('waiting', [])}
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        workers.write(JsonDB._write_atomic, self.filename, {'watermark': self.watermark,
+                                                            'reported': sorted(self.reported),
+                                                            'reported_matches': sorted(self.reported_matches),
+                                                            'waiting': list(self.waiting.values())})
+
+    @classmethod
+    def match_id(cls, match):
+        for key in cls.MATCH_ID_KEYS:
+            if isinstance(match.get(key), int):
+                return match[key]
+        return None
+
+    @staticmethod
+    def fingerprint(match):
+        return hashlib.sha1(json.dumps(match, sort_keys=True).encode()).hexdigest()[:20]
+
+    def start(self):
+        # a run begins, the watermark and the waiting games only change once commit() is called
+        self._next_watermark = self.watermark
+        self._next_waiting = dict(self.waiting)
+
+    @staticmethod
+    def is_after(match_id, watermark):
+        # matches without an id are always looked at
+        return match_id is None or watermark is None or match_id > watermark
+
+    def advance(self, match_id):
+        # also takes the highest new match id a worker process has come across
+        if match_id is not None and (self._next_watermark is None or match_id > self._next_watermark):
+            self._next_watermark = match_id
+
+    def is_reported(self, result):
+        return result.challonge_match_id in self.reported_matches or self.fingerprint(result.match) in self.reported
+
+    def mark_reported(self, result):
+        self.reported_matches.add(result.challonge_match_id)
+        self.reported.add(self.fingerprint(result.match))
+
+    def retry_waiting(self, engine):
+        """
+        Classifies the waiting games again with a fresh MatchEngine, after start(). Returns the MatchResults that can be
+        reported now, the games still without a challonge match keep waiting and the ones that aren't league games
+        anymore are dropped - once commit() is called.
+        """
+        results, waiting = engine.sort_out(self.waiting.values())
+        self._next_waiting = {self.fingerprint(match): match for match in waiting}
+        return [result for result in results if not self.is_reported(result)]
+
+    def wait(self, matches):
+        # the watermark moves past these, they're looked at again on every run by retry_waiting()
+        for match in matches:
+            self._next_waiting[self.fingerprint(match)] = match
+        for fingerprint in list(self._next_waiting)[:-self.WAITING_KEPT or None]:
+            del self._next_waiting[fingerprint]
+
+    def commit(self):
+        self.watermark = self._next_watermark
+        self.waiting = self._next_waiting
+        self.save()
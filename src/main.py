@@ -1,98 +1,87 @@
 import discord
 from discord.ext import commands
+import json
 import logging
+import time
 from os import environ
 
+import metrics
+
+from challonge_client import ChallongeClient
+from feed import MatchFeed
+from roles import RoleScheduler
+import workers
+
 logging.basicConfig(level=logging.INFO)
-REACTION_OPT_IN = "🔔"    # :bell:
-REACTION_KEEP_ROLE = "🎮"    # :video_game:
-MATCHMAKING_ROLE_ID = int(environ['MATCHMAKING_ROLE_ID'])   # @matchmaking
-GUILD_ID = int(environ['GUILD_ID'])   # Wizard Wars Reborn discord server
-CHANNEL_ID = int(environ['CHANNEL_ID'])     # Channel where the message to react to is located
-MESSAGE_TO_MONITOR = int(environ['REACTION_MESSAGE'])    # Message where the reacts should be
 BOT_TOKEN = environ['LENNYTOKEN']
 
 
-class Lenny(commands.Bot):
+class Lenny(commands.AutoShardedBot):
     def __init__(self, *args, **kwargs):
-        self.guild = None
-        self.message = None
-        self.matchmaking_users = None
-        self.opt_in_users = None
-        self.matchmaking_role = None
-        self.bot_user = None
-        self.tournament_id = environ['CHALLONGE_TOURNAMENT_ID']
+        # {name: {"challonge_id": ..., "channels": [channel ids], "prefix": storage prefix}} - without TOURNAMENTS,
+        # it's just the one tournament, keeping the storage without any prefix
+        if environ.get('TOURNAMENTS'):
+            self.tournaments = json.loads(environ['TOURNAMENTS'])
+        else:
+            self.tournaments = {'league': {'challonge_id': environ['CHALLONGE_TOURNAMENT_ID'], 'prefix': ''}}
         self.challonge_api_token = environ['CHALLONGE_API_TOKEN']
+        # one shared Challonge connection pool for all the cogs, can be pointed at a fake server for testing
+        self.challonge = ChallongeClient('theshishi', self.challonge_api_token, base_url=environ.get('CHALLONGE_API_URL', ChallongeClient.API_URL))
+        # MWW match history, streamed from sonicrat over the same connection pool
+        self.match_feed = MatchFeed(environ.get('SONICRAT_URL', MatchFeed.URL), pool=self.challonge.connector)
         super().__init__(">", *args, **kwargs)
+        # parsing and disk writes happen off the event loop from now on
+        workers.start()
+        # optional prometheus metrics endpoint
+        if environ.get('METRICS_PORT'):
+            metrics.instrument_discord(self.http)
+            metrics.Gauge('lenny_role_queue_depth', 'Role changes waiting to be applied.', function=lambda: sum(queue.queue_depth for queue in self.role_queues()))
+            for name in RoleScheduler.METRICS:
+                metrics.Counter(f'lenny_role_changes_{name}_total', f'Role changes {name} by the role queues.',
+                                function=lambda name=name: sum(queue.metrics[name] for queue in self.role_queues()))
+            self.loop.create_task(metrics.serve(int(environ['METRICS_PORT']), environ.get('METRICS_HOST', '127.0.0.1')))
 
         # extensions are loaded here
+        self.load_extension('presence')
         self.load_extension('tournament')
         self.load_extension('admin')
 
-    async def on_ready(self):
-        print('Ready!')
-        self.guild = self.get_guild(GUILD_ID)
-        self.message = await self.guild.get_channel(CHANNEL_ID).fetch_message(MESSAGE_TO_MONITOR)
-        self.matchmaking_role = self.guild.get_role(MATCHMAKING_ROLE_ID)
-        self.opt_in_users = set()
-        self.matchmaking_users = set()
-        self.bot_user = self.guild.get_member(913547605844299776)
-
-        # Remove it's own reaction before checking them if they are there by any chance
-        await self.message.remove_reaction(REACTION_KEEP_ROLE, self.bot_user)    # number is the bot's USER ID
-        await self.message.remove_reaction(REACTION_OPT_IN, self.bot_user)
-
-        # Read reactions on the message at startup
-        for reaction in self.message.reactions:
-            if reaction.emoji == REACTION_KEEP_ROLE:
-                users = await reaction.users().flatten()
-                self.matchmaking_users = {user.id for user in users}    # set of users who want to have the role always
-            if reaction.emoji == REACTION_OPT_IN:
-                users = await reaction.users().flatten()
-                self.opt_in_users = {user.id for user in users}     # set of users who opt in to having role changed based on their Discord presence
-
-        # Add it's own reactions back
-        await self.message.add_reaction(REACTION_KEEP_ROLE)
-        await self.message.add_reaction(REACTION_OPT_IN)
-
-
-intents = discord.Intents.all()
-lenny = Lenny(intents=intents, activity=discord.Game('Magicka: Wizard Wars'))
-
-
-@lenny.listen()
-async def on_raw_reaction_add(data):
-    if data.message_id == MESSAGE_TO_MONITOR and data.emoji.name == REACTION_KEEP_ROLE:
-        lenny.matchmaking_users.add(data.user_id)
-        member = lenny.guild.get_member(data.user_id)
-        await member.add_roles(lenny.matchmaking_role, reason='( ͡° ل͜ ͡°)')
-    elif data.message_id == MESSAGE_TO_MONITOR and data.emoji.name == REACTION_OPT_IN:
-        lenny.opt_in_users.add(data.user_id)
-
-
-@lenny.listen()
-async def on_raw_reaction_remove(data):
-    member = lenny.guild.get_member(data.user_id)
-    if data.message_id == MESSAGE_TO_MONITOR and data.emoji.name == REACTION_OPT_IN:
-        lenny.opt_in_users.discard(member.id)      # discard doesn't raise an error if by any chance the user isn't in set
-    elif data.message_id == MESSAGE_TO_MONITOR and data.emoji.name == REACTION_KEEP_ROLE and lenny.matchmaking_role in member.roles:
-        lenny.matchmaking_users.discard(member.id)
-        await member.remove_roles(lenny.matchmaking_role, reason='( ͠° ͟ʖ ͡°)')
-
-
-@lenny.listen()
-async def on_member_update(_, member):
-    # if user is opted in and started playing, add role
-    if member.id in lenny.opt_in_users and member.activity is not None and lenny.matchmaking_role not in member.roles:
-        if member.activity.name == 'Magicka: Wizard Wars':
-            await member.add_roles(lenny.matchmaking_role, reason='( ͡° ل͜ ͡°)')
-    # if user is opted in and stopped playing, remove role
-    elif member.id in lenny.opt_in_users and member.id not in lenny.matchmaking_users and (member.activity is None or member.activity.name != 'Magicka: Wizard Wars') and lenny.matchmaking_role in member.roles:
-        # if member.activity.name != 'Magicka: Wizard Wars':
-        await member.remove_roles(lenny.matchmaking_role, reason='( ͠° ͟ʖ ͡°)')
-    # if user is matchmaking_user and the role has been removed for any reason, add it back
-    elif member.id in lenny.matchmaking_users and lenny.matchmaking_role not in member.roles:
-        await member.add_roles(lenny.matchmaking_role, reason='( ͡° ل͜ ͡°)')
+    def role_queues(self):
+        presence = self.get_cog('Presence')
+        return [guild.roles for guild in presence.guilds.values()] if presence else []
+
+    async def close(self):
+        # unloading lets the cogs save their state and stop their background tasks
+        for name in list(self.extensions):
+            self.unload_extension(name)
+        await self.match_feed.close()
+        await self.challonge.close()
+        # waits for the last writes
+        workers.stop()
+        await super().close()
+
+
+# only what the cogs use: guilds and roles, members and their presence for the matchmaking role,
+# messages for the commands and reactions for the role message. Both members and presences are privileged.
+intents = discord.Intents.none()
+intents.guilds = True
+intents.members = True
+intents.presences = True
+intents.guild_messages = True
+intents.guild_reactions = True
+# the shards are spread over as many gateway connections as discord recommends, unless SHARD_COUNT says otherwise
+shard_count = int(environ['SHARD_COUNT']) if environ.get('SHARD_COUNT') else None
+lenny = Lenny(intents=intents, shard_count=shard_count, activity=discord.Game('Magicka: Wizard Wars'))
+
+
+@lenny.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+
+@lenny.after_invoke
+async def stop_command_timer(ctx):
+    metrics.COMMAND_SECONDS.observe(time.perf_counter() - ctx.started_at, command=ctx.command.qualified_name, failed=ctx.command_failed)
 
 
 @lenny.check
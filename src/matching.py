@@ -0,0 +1,148 @@
+from collections import namedtuple
+
+from ingest import IngestState
+
+# One league match found in the MWW match history.
+# winner/loser are team names, winner_id/loser_id their challonge participant ids and match is the original MWW match.
+MatchResult = namedtuple('MatchResult', ['challonge_match_id', 'winner', 'winner_id', 'loser', 'loser_id', 'match'])
+
+
+class MatchEngine:
+    """
+    Finds the league matches among the matches played in MWW.
+    All the lookups are built once per run, so classifying a match only takes O(players in the match).
+    """
+    def __init__(self, team_nicks, participant_ids, matches):
+        # {in-game nick: team name}
+        self.nick_to_team = {}
+        for team_name, nicks in team_nicks.items():
+            for nick in nicks:
+                self.nick_to_team[nick] = team_name
+        # {team name: challonge participant id}, challonge participants are named after the teams
+        self.participant_ids = participant_ids
+        # {frozenset of both participant ids: challonge match}, if the teams meet more than once, the open match wins
+        self.pair_to_match = {}
+        for match in matches:
+            pair = frozenset((match['player1_id'], match['player2_id']))
+            known = self.pair_to_match.get(pair)
+            if known is None or (known.get('state') != 'open' and match.get('state') == 'open'):
+                self.pair_to_match[pair] = match
+
+    @classmethod
+    def from_databases(cls, teams_db, players_db, tournament_state):
+        team_nicks = {}
+        for team in teams_db.db:
+            nicks = []
+            for discord_id in team.players:
+                try:
+                    nicks.append(players_db.find_first("discord_id", discord_id).ingame_name)
+                except KeyError:
+                    pass
+            team_nicks[team.name] = nicks
+        return cls(team_nicks, tournament_state.participant_ids, tournament_state.matches)
+
+    def classify(self, match):
+        """
+        Returns a MatchResult if the match is a finished league match, None otherwise.
+        """
+        teams = self.teams(match)
+        if teams is None:
+            return None
+        return self.result(match, *teams)
+
+    def teams(self, match):
+        """
+        Returns (winner, loser) team names if the match is a finished melee game between two registered teams,
+        None otherwise - whether challonge has a match for them or not.
+        """
+        if match['mode'] != 'melee':
+            return None
+        # {MWW team ID: team name} - everyone on one side of the match has to belong to the same registered team
+        sides = {}
+        for player in match['players']:
+            team_name = self.nick_to_team.get(player['Name'])
+            if team_name is None or sides.setdefault(player['TeamID'], team_name) != team_name:
+                return None
+        if len(sides) != 2 or len(set(sides.values())) != 2:
+            return None
+        # if the match has been ended before finished, there's no winner
+        if match['winner'] not in sides:
+            return None
+
+        winner = sides.pop(match['winner'])
+        loser = sides.popitem()[1]
+        return winner, loser
+
+    def result(self, match, winner, loser):
+        # the MatchResult of a game between two registered teams, None if challonge doesn't pair them (yet)
+        winner_id = self.participant_ids.get(winner)
+        loser_id = self.participant_ids.get(loser)
+        challonge_match = self.pair_to_match.get(frozenset((winner_id, loser_id)))
+        if challonge_match is None:
+            return None
+        return MatchResult(challonge_match['id'], winner, winner_id, loser, loser_id, match)
+
+    def classify_all(self, matches):
+        for match in matches:
+            result = self.classify(match)
+            if result is not None:
+                yield result
+
+    def sort_out(self, matches):
+        """
+        Returns ([MatchResult], [waiting matches]). Waiting are the games between two registered teams that challonge
+        has no match for yet - a later round, or a pairing that isn't in the bracket yet - they can still be reported later.
+        """
+        results = []
+        waiting = []
+        for match in matches:
+            teams = self.teams(match)
+            if teams is None:
+                continue
+            result = self.result(match, *teams)
+            if result is None:
+                waiting.append(match)
+            else:
+                results.append(result)
+        return results, waiting
+
+
+# (run id, engines) of the run this (worker) process is in the middle of, so the engines only travel once per run
+_run = (None, None)
+
+
+def classify_batch(run_id, engines, watermarks, matches, data, final=False):
+    """
+    Decodes the next piece of the feed and classifies its new matches for every division - the part of the match
+    parsing that runs in the worker process. engines and watermarks are lists in the order of the divisions, the engines
+    are only passed with the first piece of a run. matches is the JsonListStream carried over from the previous piece.
+    Returns (matches, [[MatchResult] per division], [highest new match id per division], [[waiting matches] per division]).
+    """
+    global _run
+    if engines is not None:
+        _run = (run_id, engines)
+    elif _run[0] != run_id:
+        raise RuntimeError(f'Run {run_id} has to start with the engines.')
+    engines = _run[1]
+    results = [[] for _ in engines]
+    waiting = [[] for _ in engines]
+    highest = [None] * len(engines)
+    for match in matches.feed(data, final):
+        match_id = IngestState.match_id(match)
+        melee = match.get('mode') == 'melee'
+        for i, engine in enumerate(engines):
+            if not IngestState.is_after(match_id, watermarks[i]):
+                continue
+            # the watermark moves past everything here: what can't be reported now either never will be, or waits
+            if match_id is not None and (highest[i] is None or match_id > highest[i]):
+                highest[i] = match_id
+            if melee:
+                teams = engine.teams(match)
+                if teams is None:
+                    continue
+                result = engine.result(match, *teams)
+                if result is None:
+                    waiting[i].append(match)
+                else:
+                    results[i].append(result)
+    return matches, results, highest, waiting
@@ -0,0 +1,195 @@
+"""
+Small Prometheus style metrics registry with an optional HTTP endpoint serving it in the text exposition format.
+Nothing is recorded until serve() is called, so the instrumentation is nearly free when the endpoint is off.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+enabled = False
+_metrics = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        # {tuple of label values: value}
+        self.values = {}
+        # values that are kept somewhere else anyway are only read when scraped
+        self.function = function
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def _label_string(self, key, extra=()):
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)] + list(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self):
+        if self.function is not None:
+            self.values[()] = self.function()
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{self._label_string(key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labels=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        if key not in self.values:
+            # [count in each bucket (not cumulative) + the +Inf one, sum, count]
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        observed = self.values[key]
+        observed[0][bisect_left(self.buckets, value)] += 1
+        observed[1] += value
+        observed[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        if not enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{self._label_string(key, [le])} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_string(key)} {total}')
+            lines.append(f'{self.name}_count{self._label_string(key)} {count}')
+        return lines
+
+
+class Stopwatch:
+    """
+    Adds up how long each named stage of some work took. Unlike the metrics, it always measures.
+    """
+    def __init__(self):
+        # {stage name: seconds}, in the order the stages first ran
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _measure_loop_lag(interval=1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(time.perf_counter() - start - interval)
+
+
+async def serve(port, host='127.0.0.1'):
+    """
+    Turns the metrics on and serves them on http://host:port/ (any path) until cancelled.
+    """
+    global enabled
+    enabled = True
+    server = await asyncio.start_server(_handle, host, port)
+    log.info(f'Serving metrics on {host}:{port}.')
+    lag = asyncio.ensure_future(_measure_loop_lag())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        lag.cancel()
+
+
+def instrument_discord(http):
+    """
+    Wraps discord.py's HTTPClient.request so every REST call to discord gets counted and timed.
+    """
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        if not enabled:
+            return await request(route, **kwargs)
+        with DISCORD_REQUEST_SECONDS.time(method=route.method, route=route.path):
+            return await request(route, **kwargs)
+    http.request = timed_request
+
+
+COMMAND_SECONDS = Histogram('lenny_command_seconds', 'Time spent in a bot command.', ('command', 'failed'))
+DISCORD_REQUEST_SECONDS = Histogram('lenny_discord_request_seconds', 'Latency of discord REST calls.', ('method', 'route'))
+CHALLONGE_REQUEST_SECONDS = Histogram('lenny_challonge_request_seconds', 'Latency of challonge API calls.', ('method', 'status'))
+SONICRAT_FETCH_SECONDS = Histogram('lenny_sonicrat_fetch_seconds', 'Time spent streaming and parsing the MWW match history.')
+SONICRAT_FETCH_BYTES = Gauge('lenny_sonicrat_fetch_bytes', 'Size of the last downloaded MWW match history.')
+MATCH_PARSING_SECONDS = Histogram('lenny_match_parsing_seconds', 'Duration of a whole get_played_matches run.')
+MATCHES_FOUND = Counter('lenny_matches_found_total', 'League matches found in the MWW match history.')
+RESULT_DELIVERIES = Counter('lenny_result_deliveries_total', 'Attempts to report a league result to challonge.', ('status',))
+DB_SAVE_SECONDS = Histogram('lenny_db_save_seconds', 'Time spent saving a database.', ('db',))
+DB_SAVE_BYTES = Counter('lenny_db_save_bytes_total', 'Bytes written when saving a database.', ('db',))
+RESPONSE_CACHE = Counter('lenny_response_cache_total', 'Answers of >team and >player looked up in the response cache.', ('kind', 'result'))
+PRESENCE_EVENTS = Counter('lenny_presence_events_total', 'Member updates (presence changes) handled.', ('shard',))
+EVENT_LOOP_LAG = Gauge('lenny_event_loop_lag_seconds', 'How late a one second sleep on the event loop woke up.')
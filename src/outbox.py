@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+import aiohttp
+
+from challonge_client import ChallongeError
+import metrics
+from storage import JsonDB
+import workers
+
+log = logging.getLogger(__name__)
+
+
+class ResultOutbox:
+    """
+    The league results waiting to be reported to challonge. They are saved here as soon as they are found and
+    delivered later by a background task, so finding them doesn't depend on challonge being up.
+    Every entry is one challonge match: {"match_id", "winner", "winner_id", "loser", "loser_id", "status", "attempts",
+    "next_attempt", "error", "found_at"}, the status being pending, sent or failed (challonge refused it, waits for >admin replay).
+    """
+    # retries of a failing delivery wait BACKOFF * 2^(attempts - 1) seconds, at most MAX_BACKOFF
+    BACKOFF = 30
+    MAX_BACKOFF = 3600
+    # how many delivered results are kept around to be looked at
+    SENT_KEPT = 100
+
+    def __init__(self, name='outbox'):
+        self.filename = f'{name}.json'
+        # {challonge match id: entry}, in the order they were found
+        self.entries = {}
+        try:
+            with open(self.filename, 'r') as outbox:
+                self.entries = {entry['match_id']: entry for entry in json.load(outbox)}
+        except FileNotFoundError:
+            pass
+        self._lock = None
+
+    def save(self):
+        # the copies keep the writer thread away from entries that change meanwhile
+        workers.write(JsonDB._write_atomic, self.filename, [dict(entry) for entry in self.entries.values()])
+
+    def add(self, results):
+        """
+        Queues MatchResults for delivery. A later result of a match that hasn't been sent yet replaces the earlier one,
+        the same way reporting them one after another would. Returns how many matches were new.
+        """
+        added = 0
+        for result in results:
+            entry = self.entries.get(result.challonge_match_id)
+            if entry is not None:
+                if entry['status'] == 'pending':
+                    entry.update(winner=result.winner, winner_id=result.winner_id, loser=result.loser, loser_id=result.loser_id)
+                continue
+            self.entries[result.challonge_match_id] = {
+                'match_id': result.challonge_match_id, 'winner': result.winner, 'winner_id': result.winner_id,
+                'loser': result.loser, 'loser_id': result.loser_id, 'status': 'pending', 'attempts': 0,
+                'next_attempt': 0, 'error': None, 'found_at': time.time()}
+            added += 1
+        if results:
+            self.save()
+        return added
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return [entry for entry in self.entries.values() if entry['status'] == 'pending' and entry['next_attempt'] <= now]
+
+    def replay(self, match_ids=None):
+        """
+        Makes failed entries (or the given ones, whatever their status) pending again and due right away. Returns how many.
+        """
+        if match_ids is None:
+            entries = [entry for entry in self.entries.values() if entry['status'] == 'failed']
+        else:
+            entries = [self.entries[match_id] for match_id in match_ids if match_id in self.entries]
+        for entry in entries:
+            entry.update(status='pending', attempts=0, next_attempt=0, error=None)
+        if entries:
+            self.save()
+        return len(entries)
+
+    def counts(self):
+        counts = {'pending': 0, 'sent': 0, 'failed': 0}
+        for entry in self.entries.values():
+            counts[entry['status']] += 1
+        return counts
+
+    async def deliver(self, bracket):
+        """
+        Sends everything that's due to challonge in one go. Returns how many results got delivered.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # the background task and a nudge after parsing can't send the same results twice
+        async with self._lock:
+            entries = self.due()
+            if not entries:
+                return 0
+            try:
+                state = await bracket.get()
+            except (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                log.warning(f'Cannot deliver {len(entries)} results to {bracket.tournament}, challonge is unavailable: {e}')
+                return 0
+            # reporting the same winner again changes nothing, but matches that got their result some other way are skipped
+            matches = {match['id']: match for match in state.matches}
+            to_send = []
+            for entry in entries:
+                match = matches.get(entry['match_id'])
+                if match is not None and match.get('winner_id') is not None:
+                    if match['winner_id'] == entry['winner_id']:
+                        self._sent(entry)
+                    else:
+                        self._failed(entry, 'challonge has a different winner for this match')
+                else:
+                    to_send.append(entry)
+            results = await bracket.update_matches([(entry['match_id'], {'scores_csv': '1-1', 'winner_id': str(entry['winner_id'])})
+                                                    for entry in to_send])
+            for entry, result in zip(to_send, results):
+                if not isinstance(result, Exception):
+                    log.info(f'Reported {entry["winner"]} vs. {entry["loser"]}, winner: {entry["winner"]} (challonge match {entry["match_id"]}).')
+                    self._sent(entry)
+                elif isinstance(result, ChallongeError) and result.status != 429 and result.status < 500:
+                    self._failed(entry, str(result))
+                else:
+                    if not isinstance(result, (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError)):
+                        log.error(f'Reporting challonge match {entry["match_id"]} failed:', exc_info=result)
+                    self._retry(entry, str(result) or type(result).__name__)
+            self._prune()
+            self.save()
+            return sum(1 for result in results if not isinstance(result, Exception))
+
+    def _sent(self, entry):
+        entry.update(status='sent', error=None, sent_at=time.time())
+        metrics.RESULT_DELIVERIES.inc(status='sent')
+
+    def _failed(self, entry, error):
+        log.warning(f'Challonge refused the result of match {entry["match_id"]}: {error}')
+        entry.update(status='failed', error=error)
+        metrics.RESULT_DELIVERIES.inc(status='failed')
+
+    def _retry(self, entry, error):
+        entry['attempts'] += 1
+        delay = min(self.BACKOFF * 2 ** (entry['attempts'] - 1), self.MAX_BACKOFF) * (1 + random.random() / 2)
+        entry.update(error=error, next_attempt=time.time() + delay)
+        metrics.RESULT_DELIVERIES.inc(status='retry')
+
+    def _prune(self):
+        sent = [match_id for match_id, entry in self.entries.items() if entry['status'] == 'sent']
+        for match_id in sent[:-self.SENT_KEPT or None]:
+            del self.entries[match_id]
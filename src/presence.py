@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+from os import environ
+
+from discord.ext import commands
+
+import metrics
+from roles import PresenceDebouncer, ReactionSnapshot, RoleScheduler
+
+log = logging.getLogger(__name__)
+
+REACTION_OPT_IN = "🔔"    # :bell:
+REACTION_KEEP_ROLE = "🎮"    # :video_game:
+GAME = 'Magicka: Wizard Wars'
+
+
+class GuildPresence:
+    """
+    The matchmaking role of one guild: the message to react to, the role and who wants it (always or while playing).
+    """
+    __slots__ = ('guild_id', 'channel_id', 'message_id', 'role_id', 'game', 'reactions', 'roles', 'presence_roles', 'ready')
+
+    def __init__(self, guild_id, channel_id, message_id, role_id, game=GAME, snapshot=None, debounce=30):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.role_id = role_id
+        self.game = game
+        # sets of users who reacted to the message, loaded from the last snapshot
+        self.reactions = ReactionSnapshot(snapshot or f'reactions-{guild_id}')
+        # discord rate limits role changes per guild, so every guild gets a queue of its own
+        self.roles = RoleScheduler()
+        # presence has to be stable for this many seconds before the matchmaking role follows it
+        self.presence_roles = PresenceDebouncer(self.roles, debounce)
+        # whether the reactions have been caught up with after the start
+        self.ready = False
+
+    def stop(self):
+        self.reactions.save()
+        self.presence_roles.stop()
+        self.roles.stop()
+
+
+def guilds_from_environ():
+    """
+    PRESENCE_GUILDS: [{"guild": id, "channel": id, "message": id, "role": id, "game": name, "snapshot": file name}],
+    only the first four are required. Without it, the one guild from GUILD_ID, CHANNEL_ID, REACTION_MESSAGE and
+    MATCHMAKING_ROLE_ID, with the snapshot it has always had.
+    """
+    debounce = float(environ.get('PRESENCE_DEBOUNCE', 30))
+    if environ.get('PRESENCE_GUILDS'):
+        return [GuildPresence(int(config['guild']), int(config['channel']), int(config['message']), int(config['role']),
+                              game=config.get('game', GAME), snapshot=config.get('snapshot'), debounce=debounce)
+                for config in json.loads(environ['PRESENCE_GUILDS'])]
+    return [GuildPresence(int(environ['GUILD_ID']), int(environ['CHANNEL_ID']), int(environ['REACTION_MESSAGE']),
+                          int(environ['MATCHMAKING_ROLE_ID']), snapshot='reactions', debounce=debounce)]
+
+
+class Presence(commands.Cog):
+    """
+    Gives the matchmaking role to those who react to the role message of their guild, either for good or only while
+    they are playing. Events are routed to their guild with a single dict lookup, which is all the work a presence
+    update that has nothing to do with matchmaking costs.
+    """
+    def __init__(self, bot, guilds):
+        self.bot = bot
+        # {guild id: GuildPresence}
+        self.guilds = {guild.guild_id: guild for guild in guilds}
+        # {message id: GuildPresence}, for the reaction events
+        self.messages = {guild.message_id: guild for guild in guilds}
+
+    def cog_unload(self):
+        for guild in self.guilds.values():
+            guild.stop()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready comes again after every reconnect, the snapshots are kept up to date by the reaction events meanwhile
+        waiting = [guild for guild in self.guilds.values() if not guild.ready]
+        results = await asyncio.gather(*[self._catch_up(guild) for guild in waiting], return_exceptions=True)
+        for guild, result in zip(waiting, results):
+            if isinstance(result, Exception):
+                log.warning(f'Setting up the matchmaking role in guild {guild.guild_id} failed: {result!r}')
+
+    async def _catch_up(self, state):
+        guild = self.bot.get_guild(state.guild_id)
+        if guild is None:
+            raise LookupError('the bot is not in the guild')
+        message = await guild.get_channel(state.channel_id).fetch_message(state.message_id)
+
+        # Catch up with the reactions that changed while the bot was offline
+        for reaction in message.reactions:
+            if reaction.emoji == REACTION_KEEP_ROLE:
+                await state.reactions.reconcile(reaction, state.reactions.matchmaking_users, self.bot.user.id)
+            if reaction.emoji == REACTION_OPT_IN:
+                await state.reactions.reconcile(reaction, state.reactions.opt_in_users, self.bot.user.id)
+
+        # Add it's own reactions if they aren't there
+        for emoji in (REACTION_KEEP_ROLE, REACTION_OPT_IN):
+            if not any(reaction.emoji == emoji and reaction.me for reaction in message.reactions):
+                await message.add_reaction(emoji)
+        state.ready = True
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, data):
+        state = self.messages.get(data.message_id)
+        if state is None or data.user_id == self.bot.user.id:
+            return
+        if data.emoji.name == REACTION_KEEP_ROLE:
+            state.reactions.matchmaking_users.add(data.user_id)
+            state.reactions.changed()
+            guild = self.bot.get_guild(state.guild_id)
+            member = data.member or guild.get_member(data.user_id)
+            role = guild.get_role(state.role_id)
+            if member is not None and role is not None:
+                state.roles.set_role(member, role, True, reason='( ͡° ل͜ ͡°)')
+        elif data.emoji.name == REACTION_OPT_IN:
+            state.reactions.opt_in_users.add(data.user_id)
+            state.reactions.changed()
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, data):
+        state = self.messages.get(data.message_id)
+        if state is None or data.user_id == self.bot.user.id:
+            return
+        if data.emoji.name == REACTION_OPT_IN:
+            state.reactions.opt_in_users.discard(data.user_id)     # discard doesn't raise an error if by any chance the user isn't in set
+            state.reactions.changed()
+        elif data.emoji.name == REACTION_KEEP_ROLE:
+            state.reactions.matchmaking_users.discard(data.user_id)
+            state.reactions.changed()
+            guild = self.bot.get_guild(state.guild_id)
+            member = guild.get_member(data.user_id)
+            role = guild.get_role(state.role_id)
+            # the queue drops the change if they don't have the role anyway
+            if member is not None and role is not None:
+                state.roles.set_role(member, role, False, reason='( ͠° ͟ʖ ͡°)')
+
+    @commands.Cog.listener()
+    async def on_member_update(self, _, member):
+        metrics.PRESENCE_EVENTS.inc(shard=member.guild.shard_id)
+        state = self.guilds.get(member.guild.id)
+        if state is None:
+            return
+        # if user is matchmaking_user and the role has been removed for any reason, add it back
+        if member.id in state.reactions.matchmaking_users:
+            role = member.guild.get_role(state.role_id)
+            if role is not None and role not in member.roles:
+                state.roles.set_role(member, role, True, reason='( ͡° ل͜ ͡°)')
+        # if user is opted in, the role follows whether they are playing - once it has been that way for a while.
+        # Even the updates that don't need a change have to go through, they cancel changes that are still waiting.
+        elif member.id in state.reactions.opt_in_users:
+            role = member.guild.get_role(state.role_id)
+            if role is None:
+                return
+            if member.activity is not None and member.activity.name == state.game:
+                state.presence_roles.set_role(member, role, True, reason='( ͡° ل͜ ͡°)')
+            else:
+                state.presence_roles.set_role(member, role, False, reason='( ͠° ͟ʖ ͡°)')
+
+
+def setup(bot):
+    bot.add_cog(Presence(bot, guilds_from_environ()))
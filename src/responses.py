@@ -0,0 +1,38 @@
+from collections import OrderedDict
+
+import metrics
+
+
+class ResponseCache:
+    """
+    The last answers of the info commands, keyed by (kind, key) - ('team', team name) or ('player', discord id).
+    The commands that change a team or a player forget its answers, the least recently used ones go when it's full.
+    """
+    def __init__(self, size=512):
+        self.size = size
+        self._responses = OrderedDict()
+
+    def get(self, kind, key):
+        response = self._responses.get((kind, key))
+        if response is None:
+            metrics.RESPONSE_CACHE.inc(kind=kind, result='miss')
+            return None
+        self._responses.move_to_end((kind, key))
+        metrics.RESPONSE_CACHE.inc(kind=kind, result='hit')
+        return response
+
+    def put(self, kind, key, response):
+        self._responses[(kind, key)] = response
+        self._responses.move_to_end((kind, key))
+        if len(self._responses) > self.size:
+            self._responses.popitem(last=False)
+
+    def forget(self, kind, *keys):
+        for key in keys:
+            self._responses.pop((kind, key), None)
+
+    def clear(self):
+        self._responses.clear()
+
+    def __len__(self):
+        return len(self._responses)
@@ -0,0 +1,275 @@
+import asyncio
+import heapq
+import json
+import logging
+import time
+from collections import deque
+
+import discord
+
+from storage import JsonDB
+import workers
+
+log = logging.getLogger(__name__)
+
+
+class RoleScheduler:
+    """
+    Central queue for adding and removing roles.
+    Only the latest wanted state of a member's role is kept, so changes that cancel each other out (add, then remove)
+    never reach discord. The changes are applied one by one, at most `rate` of them every `per` seconds.
+    """
+    METRICS = ('queued', 'superseded', 'applied', 'dropped', 'failed')
+
+    def __init__(self, rate=10, per=10.0):
+        self.rate = rate
+        self.per = per
+        # {(guild id, member id, role id): (member, role, wanted, reason)} - dicts keep the order, so it's a FIFO queue
+        self.pending = {}
+        self.metrics = dict.fromkeys(self.METRICS, 0)
+        self._applied_at = deque(maxlen=rate)
+        self._wakeup = None
+        self._task = None
+
+    @property
+    def queue_depth(self):
+        return len(self.pending)
+
+    def set_role(self, member, role, wanted, reason=None):
+        """
+        Asks for the member to have (wanted=True) or not have (wanted=False) the role.
+        """
+        key = (member.guild.id, member.id, role.id)
+        if key in self.pending:
+            self.metrics['superseded'] += 1
+        self.pending[key] = (member, role, wanted, reason)
+        self.metrics['queued'] += 1
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+        self._wakeup.set()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key = next(iter(self.pending))
+            member, role, wanted, reason = self.pending.pop(key)
+            # the member from the cache has up to date roles, the queued one could be long outdated
+            member = member.guild.get_member(member.id) or member
+            if (role in member.roles) == wanted:
+                self.metrics['dropped'] += 1
+                continue
+            await self._throttle()
+            try:
+                if wanted:
+                    await member.add_roles(role, reason=reason)
+                else:
+                    await member.remove_roles(role, reason=reason)
+                self.metrics['applied'] += 1
+            except discord.HTTPException as e:
+                self.metrics['failed'] += 1
+                log.warning(f'Changing role {role} of {member} failed: {e}')
+
+    async def _throttle(self):
+        if len(self._applied_at) == self.rate:
+            wait = self._applied_at[0] + self.per - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        self._applied_at.append(time.monotonic())
+
+
+class TeamRoles:
+    """
+    Gives a team role to all of the team's members at once, with at most `concurrency` requests running in parallel -
+    in total, even when several teams are being set up at the same time.
+    """
+    def __init__(self, concurrency=5):
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def create(self, guild, names, reason=None):
+        """
+        Creates a mentionable team role for each of the names. If any of them fails, the ones created are deleted again.
+        """
+        semaphore = self._get_semaphore()
+
+        async def create_role(name):
+            async with semaphore:
+                return await guild.create_role(name=name, mentionable=True, colour=discord.Colour.random(), reason=reason)
+
+        results = await asyncio.gather(*[create_role(name) for name in names], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await self.delete([result for result in results if not isinstance(result, BaseException)], reason=reason)
+            raise errors[0]
+        return results
+
+    async def delete(self, roles, reason=None):
+        semaphore = self._get_semaphore()
+
+        async def delete_role(role):
+            async with semaphore:
+                await role.delete(reason=reason)
+
+        for role, result in zip(roles, await asyncio.gather(*[delete_role(role) for role in roles], return_exceptions=True)):
+            if isinstance(result, Exception):
+                log.warning(f'Deleting role {role} failed: {result}')
+
+    async def assign(self, guild, role, discord_ids, reason=None):
+        members = await get_members(guild, discord_ids)
+        semaphore = self._get_semaphore()
+
+        async def add_role(member):
+            async with semaphore:
+                await member.add_roles(role, reason=reason)
+
+        results = await asyncio.gather(*[add_role(member) for member in members.values()], return_exceptions=True)
+        for member, result in zip(members.values(), results):
+            if isinstance(result, Exception):
+                log.warning(f'Giving role {role} to {member} failed: {result}')
+
+    @staticmethod
+    async def disband(guild, role_id, reason=None):
+        # deleting the role takes it from everyone in one request
+        role = guild.get_role(role_id)
+        if role is not None:
+            await role.delete(reason=reason)
+
+
+async def get_members(guild, discord_ids):
+    """
+    Finds the members in the guild's member cache, only the ones missing from it are fetched, 100 at a time.
+    Returns {discord id: member}, members that couldn't be found at all are left out.
+    """
+    members = {}
+    missing = []
+    for discord_id in discord_ids:
+        member = guild.get_member(discord_id)
+        if member is None:
+            missing.append(discord_id)
+        else:
+            members[discord_id] = member
+    for i in range(0, len(missing), 100):
+        chunk = missing[i:i + 100]
+        try:
+            for member in await guild.query_members(user_ids=chunk, limit=len(chunk), cache=True):
+                members[member.id] = member
+        except asyncio.TimeoutError:
+            log.warning(f'Fetching {len(chunk)} members timed out.')
+    return members
+
+
+class PresenceDebouncer:
+    """
+    Holds presence driven role changes back until the wanted state has been stable for `delay` seconds,
+    so crashing games and flickering rich presence don't add and remove the role within seconds.
+    All the members share one timer task and a heap of deadlines instead of having a task each.
+    """
+    def __init__(self, scheduler, delay):
+        self.scheduler = scheduler
+        self.delay = delay
+        # {(guild id, member id, role id): (deadline, member, role, wanted, reason)}
+        self.waiting = {}
+        # (deadline, key) - entries that have been cancelled or replaced meanwhile are skipped when they come up
+        self._deadlines = []
+        self._task = None
+
+    def set_role(self, member, role, wanted, reason=None):
+        if self.delay <= 0:
+            self.scheduler.set_role(member, role, wanted, reason=reason)
+            return
+        key = (member.guild.id, member.id, role.id)
+        waiting = self.waiting.get(key)
+        if (role in member.roles) == wanted:
+            # the state flipped back before the delay ran out, nothing to do
+            if waiting is not None:
+                del self.waiting[key]
+            return
+        if waiting is not None and waiting[3] == wanted:
+            return
+        deadline = time.monotonic() + self.delay
+        self.waiting[key] = (deadline, member, role, wanted, reason)
+        heapq.heappush(self._deadlines, (deadline, key))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.waiting.clear()
+        self._deadlines.clear()
+
+    async def _run(self):
+        # new deadlines are always the latest ones, so sleeping until the earliest one is enough
+        while self._deadlines:
+            deadline, key = self._deadlines[0]
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            heapq.heappop(self._deadlines)
+            waiting = self.waiting.get(key)
+            if waiting is None or waiting[0] != deadline:
+                continue
+            del self.waiting[key]
+            _, member, role, wanted, reason = waiting
+            self.scheduler.set_role(member, role, wanted, reason=reason)
+
+
+class ReactionSnapshot:
+    """
+    Users who have reacted to the role message, kept on the disk so that startup only has to catch up with the changes.
+    The raw reaction events keep it up to date, writes are batched into one every `save_delay` seconds.
+    """
+    def __init__(self, name='reactions', save_delay=5):
+        self.filename = f'{name}.json'
+        self.save_delay = save_delay
+        # users who want to have the role always
+        self.matchmaking_users = set()
+        # users who opt in to having role changed based on their Discord presence
+        self.opt_in_users = set()
+        self._save_handle = None
+        try:
+            with open(self.filename, 'r') as snapshot:
+                data = json.load(snapshot)
+            self.matchmaking_users = set(data['matchmaking_users'])
+            self.opt_in_users = set(data['opt_in_users'])
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        self._save_handle = None
+        workers.write(JsonDB._write_atomic, self.filename, {'matchmaking_users': sorted(self.matchmaking_users),
+                                                            'opt_in_users': sorted(self.opt_in_users)})
+
+    def changed(self):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_event_loop().call_later(self.save_delay, self.save)
+
+    async def reconcile(self, reaction, users, skip_id):
+        """
+        Brings one of the user sets in line with the reaction, streaming the reactors instead of loading them all at once.
+        The ids are always compared - the same count can still be someone else, one user having swapped for another.
+        """
+        seen = set()
+        async for user in reaction.users():
+            if user.id != skip_id:
+                seen.add(user.id)
+        if seen == users:
+            return
+        users.intersection_update(seen)
+        users.update(seen)
+        self.changed()
@@ -0,0 +1,127 @@
+"""
+The whole roster of a tournament - its players and teams - as a json or csv file, for seeding a season in one go
+with >admin import and saving it with >admin export.
+
+json: {"players": [{"name", "ingame_name", "discord_id"}], "teams": [{"name", "captain", "players": [discord ids]}]},
+      the same shape the databases are stored in, so an export can be imported again.
+csv:  discord_id,name,ingame_name,team,captain - a row per player, the team's captain has anything in the last column.
+"""
+import csv
+import io
+import json
+
+from storage import JsonDB, Player, Team
+
+CSV_FIELDS = ('discord_id', 'name', 'ingame_name', 'team', 'captain')
+
+
+class RosterError(Exception):
+    pass
+
+
+def load(filename, data):
+    """
+    Returns (players, teams) read from the contents of a .json or .csv file.
+    """
+    extension = filename.lower().rsplit('.', 1)[-1]
+    if extension not in ('json', 'csv'):
+        raise RosterError('the roster has to be a .json or .csv file.')
+    try:
+        text = data.decode('utf-8-sig')
+        if extension == 'csv':
+            return _load_csv(text)
+        return _load_json(text)
+    except (UnicodeDecodeError, json.JSONDecodeError, csv.Error, KeyError, TypeError, ValueError, AttributeError) as e:
+        raise RosterError(f'{filename} could not be read ({type(e).__name__}: {e}).') from None
+
+
+def _load_json(text):
+    roster = json.loads(text)
+    players = [Player(p['name'], ingame_name=p.get('ingame_name'), discord_id=int(p['discord_id'])) for p in roster.get('players', [])]
+    teams = [Team(t['name'], int(t['captain']), *[int(_id) for _id in t.get('players', [])]) for t in roster.get('teams', [])]
+    return players, teams
+
+
+def _load_csv(text):
+    players = []
+    # {team name: [discord ids]}, in the order the teams first come up
+    members = {}
+    captains = {}
+    for row in csv.DictReader(io.StringIO(text)):
+        player = Player(row['name'].strip(), ingame_name=(row.get('ingame_name') or '').strip() or None, discord_id=int(row['discord_id']))
+        players.append(player)
+        team_name = (row.get('team') or '').strip()
+        if team_name:
+            members.setdefault(team_name, []).append(player.discord_id)
+            if (row.get('captain') or '').strip():
+                captains[team_name] = player.discord_id
+    # a team without a marked captain is captained by its first player
+    teams = [Team(name, captains.get(name, ids[0]), *ids) for name, ids in members.items()]
+    return players, teams
+
+
+def dump(players, teams, file_format='json'):
+    """
+    Returns the roster as the contents of a file in the format load() reads.
+    """
+    if file_format == 'csv':
+        captains = {team.captain for team in teams}
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(CSV_FIELDS)
+        for player in players:
+            captain = 'x' if player.team and player.discord_id in captains else ''
+            writer.writerow([player.discord_id, player.name, player.ingame_name or '', player.team or '', captain])
+        return output.getvalue().encode()
+    return json.dumps({'players': players, 'teams': teams}, default=JsonDB._encoder, indent=1).encode()
+
+
+def check(division, players, teams):
+    """
+    Makes sure the roster can be added to the division's databases as it is, before anything is created anywhere.
+    Team members can be players from the roster or ones who are registered already and have no team.
+    Returns {team name: [players of the team]}.
+    """
+    seen = {attr: set() for attr in division.players_db.indexes}
+    for player in players:
+        for attr in seen:
+            value = getattr(player, attr)
+            if value is None:
+                continue
+            if value in seen[attr]:
+                raise RosterError(f'{attr} {value} is in the roster more than once.')
+            try:
+                division.players_db.find_first(attr, value)
+            except KeyError:
+                seen[attr].add(value)
+                continue
+            raise RosterError(f'a player with {attr} {value} is registered already.')
+
+    new_players = {player.discord_id: player for player in players}
+    members = {}
+    team_of = {}
+    for team in teams:
+        if team.name in members:
+            raise RosterError(f'team {team.name} is in the roster more than once.')
+        try:
+            division.teams_db.find_first('name', team.name)
+        except KeyError:
+            pass
+        else:
+            raise RosterError(f'team {team.name} exists already.')
+        team_players = []
+        for discord_id in team.players:
+            player = new_players.get(discord_id)
+            if player is None:
+                try:
+                    player = division.players_db.find_first('discord_id', discord_id)
+                except KeyError:
+                    raise RosterError(f'team {team.name}: player {discord_id} is neither in the roster nor registered.') from None
+                if player.team:
+                    raise RosterError(f'team {team.name}: {player.name} already plays for {player.team}.')
+            if discord_id in team_of:
+                raise RosterError(f'{player.name} is in both {team_of[discord_id]} and {team.name}.')
+            team_of[discord_id] = team.name
+            team_players.append(player)
+        members[team.name] = team_players
+    return members
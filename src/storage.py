@@ -0,0 +1,584 @@
+import json
+import operator
+import os
+import sqlite3
+import sys
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+
+import metrics
+import workers
+
+
+class DuplicateKeyError(ValueError):
+    pass
+
+
+class JsonDB:
+    # the journal gets folded into the snapshot once it has this many entries, even if compact() isn't called
+    JOURNAL_LIMIT = 1000
+
+    def __init__(self, db_name, indexes=(), journal=False):
+        self.db_name = db_name
+        self.db = []
+        self.filename = f'{self.db_name}.json'
+        # {attribute: {value: record}} - unique hash indexes, so lookups don't have to scan the whole db
+        self.indexes = {attr: {} for attr in indexes}
+        # the first index is the primary key, which is what journal entries refer to
+        self.key = indexes[0] if indexes else None
+        # journal mode: save() only appends the changed records to {db_name}.journal and the json file becomes a snapshot
+        self.journal = journal
+        self.journal_filename = f'{self.db_name}.journal'
+        self.journal_size = 0
+        self._dirty = set()
+        self._deleted = set()
+        self._reset = False
+        # [(function, args)] that undo the changes made since begin(), None outside of a transaction
+        self._undo = None
+        try:
+            with open(self.filename, 'x') as db:
+                json.dump(self.db, db, default=self._encoder)
+        except FileExistsError:
+            self._load(self.filename)
+        self._dirty.clear()
+        self._deleted.clear()
+        if self.journal and not self._replay():
+            # don't append new entries behind a broken line
+            self.compact()
+
+    def save(self):
+        self._undo = None
+        if not self.journal or self._reset:
+            self.compact()
+            return
+        if not (self._dirty or self._deleted):
+            return
+        # the changed records are encoded right away, the file is written by the writer thread
+        lines = [json.dumps({'del': key}) for key in self._deleted]
+        lines += [json.dumps({'put': self.find_first(self.key, key)}, default=self._encoder) for key in self._dirty]
+        workers.write(self._append_journal, '\n'.join(lines) + '\n')
+        self.journal_size += len(lines)
+        self._dirty.clear()
+        self._deleted.clear()
+        if self.journal_size >= self.JOURNAL_LIMIT:
+            self.compact()
+
+    def _append_journal(self, data):
+        with metrics.DB_SAVE_SECONDS.time(db=self.db_name):
+            with open(self.journal_filename, 'a') as journal:
+                journal.write(data)
+                journal.flush()
+                os.fsync(journal.fileno())
+        metrics.DB_SAVE_BYTES.inc(len(data), db=self.db_name)
+
+    def compact(self):
+        # a snapshot of the records as plain dicts, which the writer thread can encode while the records keep changing
+        records = [self._encoder(record) for record in self.db]
+        truncate = self.journal and (self.journal_size or os.path.exists(self.journal_filename))
+        workers.write(self._write_snapshot, records, truncate)
+        self._dirty.clear()
+        self._deleted.clear()
+        self._reset = False
+        if truncate:
+            self.journal_size = 0
+
+    def _write_snapshot(self, records, truncate):
+        # write a fresh snapshot first, the journal is only dropped once the snapshot is safely on the disk
+        with metrics.DB_SAVE_SECONDS.time(db=self.db_name):
+            self._write_atomic(self.filename, records)
+        if metrics.enabled:
+            metrics.DB_SAVE_BYTES.inc(os.path.getsize(self.filename), db=self.db_name)
+        if truncate:
+            with open(self.journal_filename, 'w'):
+                pass
+
+    def begin(self):
+        # the changes from here on can be undone by rollback(), without waiting for the writer thread and the disk
+        self._undo = []
+
+    def rollback(self):
+        # throw away the changes made since begin(), the newest first. The undone records get saved again with the
+        # next save(), which changes nothing on the disk
+        undo, self._undo = self._undo or [], None
+        for function, args in reversed(undo):
+            function(*args)
+
+    def _log(self, function, *args):
+        if self._undo is not None:
+            self._undo.append((function, args))
+
+    def _load(self, filename):
+        with open(filename, 'r') as db:
+            records = json.load(db, object_hook=self._decoder)
+        # the indexes are filled in bulk, _load only ever runs on an empty db and a freshly loaded db has nothing to save
+        for attr, index in self.indexes.items():
+            values = list(map(operator.attrgetter(attr), records))
+            index.update(zip(values, records))
+            index.pop(None, None)
+            if len(index) != len(values) - values.count(None):
+                duplicate = next(value for value, count in Counter(values).items() if count > 1 and value is not None)
+                raise DuplicateKeyError(f"{self.db_name}: a record with {attr} '{duplicate}' already exists.")
+        for record in records:
+            object.__setattr__(record, '_db', self)
+        self.db.extend(records)
+
+    def _replay(self):
+        try:
+            with open(self.journal_filename, 'r') as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line, object_hook=self._decoder)
+                    except json.JSONDecodeError:
+                        # a half-written last line from a crash, everything before it is fine
+                        return False
+                    self.journal_size += 1
+                    key = entry['del'] if 'del' in entry else getattr(entry['put'], self.key)
+                    try:
+                        self.remove(self.find_first(self.key, key))
+                    except KeyError:
+                        pass
+                    if 'put' in entry:
+                        self.append(entry['put'])
+        except FileNotFoundError:
+            pass
+        self._dirty.clear()
+        self._deleted.clear()
+        return True
+
+    @staticmethod
+    def _write_atomic(filename, records):
+        tmp_filename = f'{filename}.tmp'
+        with open(tmp_filename, 'w') as db:
+            json.dump(records, db, default=JsonDB._encoder)
+            db.flush()
+            os.fsync(db.fileno())
+        os.replace(tmp_filename, filename)
+
+    def find_first(self, attr, value):
+        if attr in self.indexes:
+            try:
+                return self.indexes[attr][value]
+            except KeyError:
+                raise KeyError(f'Theres no such object in the database.') from None
+        try:
+            return next((p for p in self.db if getattr(p, attr) == value))
+        except StopIteration:
+            raise KeyError(f'Theres no such object in the database.') from None
+
+    def append(self, record):
+        for attr in self.indexes:
+            self._check_unique(record, attr, getattr(record, attr))
+        for attr, index in self.indexes.items():
+            value = getattr(record, attr)
+            if value is not None:
+                index[value] = record
+        record._db = self
+        self.db.append(record)
+        self._touch(record)
+        self._log(self.remove, record)
+
+    def remove(self, record):
+        position = self.db.index(record)
+        del self.db[position]
+        self._log(self._reinsert, record, position)
+        record._db = None
+        for attr, index in self.indexes.items():
+            index.pop(getattr(record, attr), None)
+        if self.key is not None:
+            key = getattr(record, self.key)
+            self._dirty.discard(key)
+            self._deleted.add(key)
+
+    def _reinsert(self, record, position):
+        self.append(record)
+        self.db.insert(position, self.db.pop())
+
+    def clear(self):
+        self._log(self._refill, self.db, self._reset)
+        for record in self.db:
+            record._db = None
+        self.db = []
+        for index in self.indexes.values():
+            index.clear()
+        self._reset = True
+
+    def _refill(self, records, reset):
+        for record in records:
+            self.append(record)
+        self._reset = reset
+
+    def _touch(self, record):
+        if self.key is not None:
+            key = getattr(record, self.key)
+            self._deleted.discard(key)
+            self._dirty.add(key)
+
+    # called by the records themselves whenever one of their attributes is about to change
+    def _update(self, record, attr, old, new):
+        # a rejected change mustn't leave anything behind, least of all a deleted key
+        indexed = attr in self.indexes and old != new
+        if indexed:
+            self._check_unique(record, attr, new)
+        self._log(setattr, record, attr, old)
+        if attr == self.key and old != new:
+            self._dirty.discard(old)
+            self._deleted.add(old)
+            self._deleted.discard(new)
+            self._dirty.add(new)
+        else:
+            self._touch(record)
+        if not indexed:
+            return
+        index = self.indexes[attr]
+        if old is not None:
+            index.pop(old, None)
+        if new is not None:
+            index[new] = record
+
+    def _check_unique(self, record, attr, value):
+        if value is None:
+            return
+        other = self.indexes[attr].get(value)
+        if other is not None and other is not record:
+            raise DuplicateKeyError(f"{self.db_name}: a record with {attr} '{value}' already exists.")
+
+    @staticmethod
+    def _decoder(dct):
+        if 'captain' in dct:
+            return Team._from_dict(dct)
+        elif 'discord_id' in dct:
+            return Player._from_dict(dct)
+        return dct
+
+    @staticmethod
+    def _encoder(o):
+        if isinstance(o, Player):
+            return {'name': o.name,
+                    'ingame_name': o.ingame_name,
+                    'team': o.team,
+                    'discord_id': o.discord_id
+                    }
+        elif isinstance(o, Team):
+            return {'name': o.name,
+                    'captain': o.captain,
+                    'players': list(o.players),
+                    'challonge_id': o.challonge_id,
+                    'discord_role': o.discord_role
+                    }
+        return json.JSONEncoder().default(o)
+
+
+class SqliteDB:
+    """
+    Same interface as JsonDB, backed by a table in an SQLite database.
+    Indexed attributes get their own (unique) columns, the rest of the record is stored as json in the data column.
+    Changes are written to the table straight away and become permanent once save() commits them.
+    """
+    def __init__(self, connection, db_name, indexes):
+        self.connection = connection
+        self.db_name = db_name
+        self.indexes = indexes
+        self.key = indexes[0]
+        # records handed out to the cogs, so that the same row is always the same python object
+        self._records = weakref.WeakValueDictionary()
+        # {id(record): (record, its key before the transaction or None if it's new)} since begin(), None outside of one
+        self._changed = None
+        columns = ', '.join([f'{self.key} PRIMARY KEY'] + [f'{attr} UNIQUE' for attr in indexes[1:]] + ['data TEXT NOT NULL'])
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {self.db_name} ({columns})')
+        # one-shot migration from the json files
+        if not self.connection.execute(f'SELECT 1 FROM {self.db_name} LIMIT 1').fetchone() and os.path.exists(f'{self.db_name}.json'):
+            self.migrate_from_json()
+
+    @property
+    def db(self):
+        return [self._record(data) for data, in self.connection.execute(f'SELECT data FROM {self.db_name}')]
+
+    def save(self):
+        self._changed = None
+        self.connection.commit()
+
+    def compact(self):
+        pass
+
+    def begin(self):
+        # sqlite starts a transaction with the first change by itself, the records it changes are remembered here
+        self._changed = {}
+
+    def rollback(self):
+        """
+        Throws away the uncommitted changes. Only the records changed since begin() are touched - they get the state of
+        their row back, or are let go if the row is gone - the ones other commands hold stay as they are.
+        """
+        self.connection.rollback()
+        changed, self._changed = self._changed or {}, None
+        for record, key in changed.values():
+            current = getattr(record, self.key)
+            if self._records.get(current) is record:
+                del self._records[current]
+            record._db = None
+            if key is None or key in self._records:
+                continue
+            row = self.connection.execute(f'SELECT data FROM {self.db_name} WHERE {self.key} = ?', (key,)).fetchone()
+            if row is None:
+                continue
+            record._assign(JsonDB._decoder(json.loads(row[0])))
+            record._db = self
+            self._records[key] = record
+
+    def _remember(self, record, key):
+        if self._changed is not None and id(record) not in self._changed:
+            self._changed[id(record)] = (record, key)
+
+    def find_first(self, attr, value):
+        if attr in self.indexes:
+            row = self.connection.execute(f'SELECT data FROM {self.db_name} WHERE {attr} = ?', (value,)).fetchone()
+            if row is None:
+                raise KeyError(f'Theres no such object in the database.')
+            return self._record(row[0])
+        try:
+            return next((p for p in self.db if getattr(p, attr) == value))
+        except StopIteration:
+            raise KeyError(f'Theres no such object in the database.') from None
+
+    def append(self, record):
+        data = JsonDB._encoder(record)
+        columns = ', '.join(self.indexes)
+        placeholders = ', '.join('?' * (len(self.indexes) + 1))
+        try:
+            self.connection.execute(f'INSERT INTO {self.db_name} ({columns}, data) VALUES ({placeholders})',
+                                    [data[attr] for attr in self.indexes] + [json.dumps(data)])
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f'{self.db_name}: {e}') from None
+        self._remember(record, None)
+        record._db = self
+        self._records[data[self.key]] = record
+
+    def remove(self, record):
+        key = getattr(record, self.key)
+        self._remember(record, key)
+        self.connection.execute(f'DELETE FROM {self.db_name} WHERE {self.key} = ?', (key,))
+        self._records.pop(key, None)
+        record._db = None
+
+    def clear(self):
+        self.connection.execute(f'DELETE FROM {self.db_name}')
+        for record in list(self._records.values()):
+            record._db = None
+        self._records.clear()
+
+    def migrate_from_json(self):
+        old_db = JsonDB(self.db_name, indexes=self.indexes, journal=os.path.exists(f'{self.db_name}.journal'))
+        for record in old_db.db:
+            self.append(record)
+        self.save()
+        # keep the old files around, but make sure they don't get migrated again
+        for filename in (old_db.filename, old_db.journal_filename):
+            if os.path.exists(filename):
+                os.replace(filename, f'{filename}.migrated')
+
+    def _record(self, data):
+        dct = json.loads(data)
+        record = self._records.get(dct[self.key])
+        if record is None:
+            record = JsonDB._decoder(dct)
+            record._db = self
+            self._records[dct[self.key]] = record
+        return record
+
+    def _touch(self, record):
+        self._remember(record, getattr(record, self.key))
+        self._write(record, JsonDB._encoder(record))
+
+    def _log(self, function, *args):
+        # the connection undoes everything by itself
+        pass
+
+    # called by the records themselves whenever one of their attributes is about to change
+    def _update(self, record, attr, old, new):
+        if old == new:
+            return
+        self._remember(record, old if attr == self.key else getattr(record, self.key))
+        data = JsonDB._encoder(record)
+        data[attr] = new
+        self._write(record, data)
+        if attr == self.key:
+            self._records.pop(old, None)
+            self._records[new] = record
+
+    def _write(self, record, data):
+        assignments = ', '.join(f'{attr} = ?' for attr in self.indexes)
+        try:
+            self.connection.execute(f'UPDATE {self.db_name} SET {assignments}, data = ? WHERE {self.key} = ?',
+                                    [data[attr] for attr in self.indexes] + [json.dumps(data), getattr(record, self.key)])
+        except sqlite3.IntegrityError as e:
+            raise DuplicateKeyError(f'{self.db_name}: {e}') from None
+
+
+_connections = {}
+
+
+def open_db(db_name, indexes, backend='json', journal=False, sqlite_file='lenny.sqlite3'):
+    if backend == 'sqlite':
+        if sqlite_file not in _connections:
+            # the databases are loaded on the writer thread but used on the event loop, never both at once
+            connection = sqlite3.connect(sqlite_file, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = WAL')
+            _connections[sqlite_file] = connection
+        return SqliteDB(_connections[sqlite_file], db_name, indexes)
+    return JsonDB(db_name, indexes=indexes, journal=journal)
+
+
+@contextmanager
+def transaction(*dbs):
+    """
+    Saves all the databases at the end of the block or undoes the changes made in it if it raises.
+    SQLite databases sharing a file are committed together, so the whole block is atomic.
+    """
+    for db in dbs:
+        db.begin()
+    try:
+        yield
+    except BaseException:
+        for db in dbs:
+            db.rollback()
+        raise
+    for db in dbs:
+        db.save()
+
+
+class Record:
+    """
+    Records tell the database they belong to about attribute changes, so it can keep its indexes and journal up to date.
+    They are slotted, and the strings that repeat across records are interned, a league's worth of them is kept in
+    memory all the time.
+    """
+    __slots__ = ('_db', '__weakref__')
+    # attributes holding strings many records share - interning the unique ones would only grow python's intern table
+    _interned = ()
+
+    def __init__(self):
+        object.__setattr__(self, '_db', None)
+
+    def __setattr__(self, attr, value):
+        if attr in self._interned and type(value) is str:
+            value = sys.intern(value)
+        if self._db is not None and attr != '_db':
+            self._db._update(self, attr, getattr(self, attr, None), value)
+        object.__setattr__(self, attr, value)
+
+    def _assign(self, other):
+        # takes over the state of another copy of the same record, without telling the db about it
+        for attr in self.__slots__:
+            value = getattr(other, attr)
+            current = getattr(self, attr, None)
+            if isinstance(current, RecordSet):
+                set.clear(current)
+                set.update(current, value)
+            else:
+                object.__setattr__(self, attr, value)
+
+
+class RecordSet(set):
+    # set of ids that marks its record as changed when it's modified, so journaled saves pick the change up
+    __slots__ = ('owner',)
+
+    def __init__(self, owner, *args):
+        super().__init__(*args)
+        self.owner = owner
+
+    def _changing(self):
+        # lets a rolled back transaction put the ids back
+        if self.owner._db is not None:
+            self.owner._db._log(self._restore, set(self))
+
+    def _changed(self):
+        if self.owner._db is not None:
+            self.owner._db._touch(self.owner)
+
+    def _restore(self, items):
+        super().clear()
+        super().update(items)
+        self._changed()
+
+
+def _tracked(name):
+    method = getattr(set, name)
+
+    def tracked(self, *args):
+        self._changing()
+        result = method(self, *args)
+        self._changed()
+        return result
+    tracked.__name__ = name
+    return tracked
+
+
+# every way of changing a set in place, the in-place operators included, goes through the db
+for _name in ('add', 'remove', 'discard', 'pop', 'clear', 'update', 'difference_update', 'intersection_update',
+              'symmetric_difference_update', '__ior__', '__iand__', '__isub__', '__ixor__'):
+    setattr(RecordSet, _name, _tracked(_name))
+
+
+class Player(Record):
+    __slots__ = ('name', 'ingame_name', 'team', 'discord_id')
+    _interned = ('team',)
+
+    def __init__(self, name, ingame_name=None, team=None, discord_id=None):
+        super().__init__()
+        self.name = name
+        self.ingame_name = ingame_name
+        self.team = team
+        self.discord_id = discord_id
+
+    @classmethod
+    def _from_dict(cls, dct):
+        # decodes straight into the slots, skipping __init__ and __setattr__ - nothing to tell a db about yet
+        player = cls.__new__(cls)
+        _set = object.__setattr__
+        _set(player, '_db', None)
+        _set(player, 'name', dct['name'])
+        _set(player, 'ingame_name', dct['ingame_name'])
+        team = dct['team']
+        _set(player, 'team', team if team is None else sys.intern(team))
+        _set(player, 'discord_id', dct['discord_id'])
+        return player
+
+
+class Team(Record):
+    __slots__ = ('name', 'captain', 'players', 'challonge_id', 'discord_role')
+    _interned = ('name',)
+
+    def __init__(self, name, captain, *args, challonge_id=None, discord_role=None):
+        super().__init__()
+        self.name = name
+        self.captain = captain
+        self.players = RecordSet(self)
+        for person in args:
+            self.players.add(person)
+        self.players.add(captain)
+        self.challonge_id = challonge_id
+        self.discord_role = discord_role
+
+    @classmethod
+    def _from_dict(cls, dct):
+        team = cls.__new__(cls)
+        _set = object.__setattr__
+        _set(team, '_db', None)
+        _set(team, 'name', sys.intern(dct['name']))
+        _set(team, 'captain', dct['captain'])
+        players = RecordSet(team, dct['players'])
+        players.add(dct['captain'])
+        _set(team, 'players', players)
+        _set(team, 'challonge_id', dct['challonge_id'])
+        _set(team, 'discord_role', dct['discord_role'])
+        return team
+
+
+# python3 storage.py [sqlite file] - moves teamsDB.json and playersDB.json into the sqlite database
+if __name__ == '__main__':
+    sqlite_file = sys.argv[1] if len(sys.argv) > 1 else 'lenny.sqlite3'
+    open_db('teamsDB', ('name',), backend='sqlite', sqlite_file=sqlite_file)
+    open_db('playersDB', ('discord_id', 'name', 'ingame_name'), backend='sqlite', sqlite_file=sqlite_file)
+    print(f'Migrated to {sqlite_file}.')
@@ -1,78 +1,226 @@
-import json
+import asyncio
+import copy
+import logging
+import time
 
+import aiohttp
 import discord
 from discord.ext import commands, tasks
-import challonge
-import requests
 from os import environ
 
-class JsonDB:
-    def __init__(self, db_name):
-        self.db_name = db_name
-        self.db = []
-        self.filename = f'{self.db_name}.json'
-        try:
-            with open(self.filename, 'x') as db:
-                json.dump(self.db, db, default=self._encoder)
-        except FileExistsError:
-            with open(self.filename, 'r+') as db:
-                self.db = json.load(db, object_hook=self._decoder)
+from challonge_client import ChallongeError, TournamentCache
+from feed import JsonListStream
+import metrics
+from ingest import IngestState
+from matching import MatchEngine, classify_batch
+from outbox import ResultOutbox
+from responses import ResponseCache
+from roles import TeamRoles, get_members
+from storage import DuplicateKeyError, Player, Team, open_db, transaction
+import workers
 
-    def save(self):
-        with open(self.filename, 'w') as db:
-            json.dump(self.db, db, default=self._encoder)
+log = logging.getLogger(__name__)
 
-    def find_first(self, attr, value):
-        try:
-            return next((p for p in self.db if vars(p)[attr] == value))
-        except StopIteration:
-            raise KeyError(f'Theres no such object in the database.') from None
 
-    @staticmethod
-    def _decoder(dct):
-        if 'captain' in dct.keys():
-            return Team(dct['name'], dct['captain'], *dct['players'], challonge_id=dct['challonge_id'], discord_role=dct['discord_role'])
-        elif 'discord_id' in dct.keys():
-            player = Player(dct['name'], ingame_name=dct['ingame_name'], team=dct['team'], discord_id=dct['discord_id'])
-            return player
-        return dct
+class UnknownTournament(commands.CheckFailure):
+    pass
 
-    @staticmethod
-    def _encoder(o):
-        if isinstance(o, Player):
-            return {'name': o.name,
-                    'ingame_name': o.ingame_name,
-                    'team': o.team,
-                    'discord_id': o.discord_id
-                    }
-        elif isinstance(o, Team):
-            return {'name': o.name,
-                    'captain': o.captain,
-                    'players': list(o.players),
-                    'challonge_id': o.challonge_id,
-                    'discord_role': o.discord_role
-                    }
-        return json.JSONEncoder().default(o)
+
+class Division:
+    """
+    One of the tournaments the bot runs: its challonge bracket, databases and how far its match ingestion has got.
+    Every division has its own files (or sqlite tables), all starting with `prefix`.
+    """
+    def __init__(self, name, tourney_url, challonge, channels=(), prefix=''):
+        self.name = name
+        if Tournament.TESTING:
+            self.full_url = f"{tourney_url}"
+        else:
+            self.full_url = f"{Tournament.CHALLONGE_SUBDOMAIN}-{tourney_url}"
+        # commands sent in these channels are meant for this division
+        self.channels = set(channels)
+        if not f'{prefix}teamsDB'.isidentifier():
+            raise ValueError(f'Tournament {name}: storage prefix {prefix!r} can only have letters, digits and underscores.')
+        self.prefix = prefix
+        # participants and matches of the tournament, refreshed in the background and after our own changes
+        self.bracket = TournamentCache(challonge, self.full_url)
+        self.journal = int(environ.get('DB_JOURNAL', 0))
+        # answers of >team and >player, forgotten by every command that changes what they show
+        self.responses = ResponseCache()
+        # held by the commands that add teams from checking the names and players until they're stored, so two
+        # registrations can't both pass the checks while waiting for challonge and discord
+        self.registration = asyncio.Lock()
+        # filled in by load()
+        self.teams_db = None
+        self.players_db = None
+        self.ingest_state = None
+        self.outbox = None
+
+    def load(self):
+        """
+        Opens the databases and the ingestion state. It's all blocking reads, so the cog does it off the event loop.
+        """
+        backend = environ.get('DB_BACKEND', 'json')
+        self.teams_db = open_db(f'{self.prefix}teamsDB', ('name',), backend=backend, journal=self.journal)
+        self.players_db = open_db(f'{self.prefix}playersDB', ('discord_id', 'name', 'ingame_name'), backend=backend, journal=self.journal)
+        self.ingest_state = IngestState(f'{self.prefix}ingestState')
+        self.outbox = ResultOutbox(f'{self.prefix}outbox')
+
+
+class NotReady(commands.CheckFailure):
+    pass
 
 
 class Tournament(commands.Cog):
     CHALLONGE_SUBDOMAIN = "9d7a92ca1e0988a11ef9d7ab"
     TESTING = int(environ['TESTING'])
+    # how long a command waits for the databases to load before giving up
+    READY_TIMEOUT = 15
 
-    def __init__(self, tourney_url, challonge_api_token):
-        if Tournament.TESTING:
-            self.full_url = f"{tourney_url}"
-        else:
-            self.full_url = f"{Tournament.CHALLONGE_SUBDOMAIN}-{tourney_url}"
-        challonge.set_credentials('theshishi', challonge_api_token)
-        self.challonge_tournament = challonge.tournaments.show(self.full_url, include_participants=1, include_matches=1)
-        self.teams_db = JsonDB('teamsDB')
-        self.players_db = JsonDB('playersDB')
+    def __init__(self, tournaments, challonge, match_feed):
+        """
+        tournaments: {name: {"challonge_id": ..., "channels": [channel ids], "prefix": storage prefix (default "<name>_")}}
+        """
+        # the challonge connection pool and the match feed are shared by all the divisions
+        self.challonge = challonge
+        self.match_feed = match_feed
+        self.divisions = {}
+        for name, config in tournaments.items():
+            self.divisions[name] = Division(name, config['challonge_id'], challonge, channels=config.get('channels', ()),
+                                            prefix=config.get('prefix', f'{name}_'))
+        # the cog is usable as soon as it's added - the databases load in the background and the commands that need
+        # them wait for it, the brackets are fetched by the first refresh or whatever needs them first
+        self.ready = asyncio.Event()
+        self.load_error = None
+        # held by a match parsing run from start to end - the worker process and the ingest states are in one run at a time
+        self.parsing = asyncio.Lock()
+        self._warm_up = asyncio.ensure_future(self.warm_up())
+        self.refresh_bracket.start()
         self.member_converter = commands.MemberConverter()
+        self.team_roles = TeamRoles()
         self.registration_open = int(environ['REGISTRATION_OPEN'])
         # Betting disabled for now
         # self.betting = Betting(self)
 
+    def cog_unload(self):
+        self._warm_up.cancel()
+        self.compact_databases.cancel()
+        self.refresh_bracket.cancel()
+        self.deliver_results.cancel()
+
+    async def warm_up(self):
+        start = time.perf_counter()
+        try:
+            # on the writer thread, so on a reload it's the files with everything the old cog wrote in them
+            for division in self.divisions.values():
+                await workers.run_after_writes(division.load)
+        except Exception as e:
+            self.load_error = e
+            log.error('Loading the tournaments failed:', exc_info=e)
+        else:
+            log.info(f'Loaded {len(self.divisions)} tournament(s) in {time.perf_counter() - start:.1f}s.')
+            if any(division.journal for division in self.divisions.values()):
+                self.compact_databases.start()
+            self.deliver_results.start()
+        finally:
+            self.ready.set()
+
+    async def wait_until_ready(self):
+        """
+        Waits for the databases to load. Raises NotReady if they take too long or can't be loaded.
+        """
+        if not self.ready.is_set():
+            try:
+                await asyncio.wait_for(self.ready.wait(), self.READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise NotReady('the tournament data is still loading, try again in a moment.') from None
+        if self.load_error is not None:
+            raise NotReady(f'the tournament data could not be loaded ({self.load_error}).')
+
+    def division_for(self, ctx):
+        """
+        The division a command is meant for - picked with >in, by the channel, or the only one there is. None if unclear.
+        """
+        division = getattr(ctx, 'division', None)
+        if division is not None:
+            return division
+        for division in self.divisions.values():
+            if ctx.channel.id in division.channels:
+                return division
+        if len(self.divisions) == 1:
+            return next(iter(self.divisions.values()))
+        return None
+
+    async def cog_check(self, ctx):
+        if ctx.command in (self.in_division, self.list_divisions):
+            return True
+        ctx.division = self.division_for(ctx)
+        if ctx.division is None:
+            raise UnknownTournament(f'this channel belongs to no tournament. Use `>in <tournament> <command>`, '
+                                    f'the tournaments are: {", ".join(self.divisions)}.')
+        await self.wait_until_ready()
+        return True
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, (UnknownTournament, NotReady)):
+            await ctx.send(f'{ctx.author.mention}, {error}')
+        else:
+            # having this handler turns off the default one, which would have printed it
+            log.error(f'Ignoring exception in command {ctx.command}:', exc_info=error)
+
+    @commands.command(name='in')
+    async def in_division(self, ctx, tournament, *, command):
+        """
+        Runs a command for the given tournament, wherever it's sent. Usage: >in <tournament> <command>
+        """
+        division = self.divisions.get(tournament)
+        if division is None:
+            await ctx.send(f'{ctx.author.mention}, there is no tournament {tournament}. The tournaments are: {", ".join(self.divisions)}.')
+            return
+        message = copy.copy(ctx.message)
+        message.content = f'{ctx.prefix}{command}'
+        new_ctx = await ctx.bot.get_context(message)
+        new_ctx.division = division
+        await ctx.bot.invoke(new_ctx)
+
+    @commands.command(name='tournaments')
+    async def list_divisions(self, ctx):
+        """
+        Lists the tournaments and the channels they are run in.
+        """
+        lines = []
+        for division in self.divisions.values():
+            channels = ', '.join(f'<#{channel_id}>' for channel_id in sorted(division.channels))
+            lines.append(f'-> {division.name}' + (f' in {channels}' if channels else ''))
+        await ctx.send('Tournaments:\n' + '\n'.join(lines))
+
+    @tasks.loop(minutes=5)
+    async def refresh_bracket(self):
+        brackets = [division.bracket for division in self.divisions.values()]
+        results = await asyncio.gather(*[bracket.refresh() for bracket in brackets], return_exceptions=True)
+        for division, result in zip(self.divisions.values(), results):
+            if isinstance(result, (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError)):
+                log.warning(f'Refreshing the challonge tournament {division.name} failed: {result}')
+            elif isinstance(result, Exception):
+                # anything raised out of a tasks.loop stops it for good, one bad response mustn't end the refreshes
+                log.error(f'Refreshing the challonge tournament {division.name} failed:', exc_info=result)
+
+    @tasks.loop(seconds=30)
+    async def deliver_results(self):
+        # every division's outbox is sent on its own, a tournament challonge refuses doesn't hold up the others
+        results = await asyncio.gather(*[division.outbox.deliver(division.bracket) for division in self.divisions.values()],
+                                       return_exceptions=True)
+        for division, result in zip(self.divisions.values(), results):
+            if isinstance(result, Exception):
+                log.error(f'Delivering the results of {division.name} failed:', exc_info=result)
+
+    @tasks.loop(minutes=30)
+    async def compact_databases(self):
+        # fold the journals into fresh snapshots so they don't grow forever
+        for division in self.divisions.values():
+            division.teams_db.compact()
+            division.players_db.compact()
+
     @staticmethod
     # small method to make sure we don't have issues with nicks vs. names on discord
     def _get_discord_nick(ctx, user=None):
@@ -84,9 +232,10 @@ class Tournament(commands.Cog):
         else:
             return user.nick
 
-    async def is_captain(self, ctx):
+    # command checks only get the context, the cog's own check has already picked the division by then
+    async def is_captain(ctx):
         try:
-            player = self.players_db.find_first("discord_id", ctx.author.id)
+            player = ctx.division.players_db.find_first("discord_id", ctx.author.id)
         except KeyError:
             await ctx.send(f"{ctx.author.mention}, you have to register first.")
             return False
@@ -95,7 +244,7 @@ class Tournament(commands.Cog):
             await ctx.send(f"{ctx.author.mention}, you are not a captain of any team.")
             return False
 
-        team = self.teams_db.find_first("name", player.team)
+        team = ctx.division.teams_db.find_first("name", player.team)
         if ctx.author.id != team.captain:
             await ctx.send(f"{ctx.author.mention}, only captain of the team can do this!")
             return False
@@ -106,22 +255,23 @@ class Tournament(commands.Cog):
         """
         Register yourself for the tournament.
         """
+        division = ctx.division
         if not (self.registration_open or Tournament.TESTING):
             await ctx.send(f'The registration has not been opened yet!')
             return True
         # Check if the user is already registered
-        try:
-            if self.players_db.find_first("discord_id", ctx.author.id) or \
-              self.players_db.find_first("name", self._get_discord_nick(ctx)) or \
-              self.players_db.find_first("ingame_name", ingame_name):
+        for attr, value in (("discord_id", ctx.author.id), ("name", self._get_discord_nick(ctx)), ("ingame_name", ingame_name)):
+            try:
+                division.players_db.find_first(attr, value)
                 await ctx.send(f'{ctx.author.mention}, you are already registered!')
                 return
-        except KeyError:
-            pass
+            except KeyError:
+                pass
 
         # create the player and save him into the database.
-        self.players_db.db.append(Player(self._get_discord_nick(ctx), ingame_name=ingame_name, discord_id=ctx.author.id))
-        self.players_db.save()
+        division.players_db.append(Player(self._get_discord_nick(ctx), ingame_name=ingame_name, discord_id=ctx.author.id))
+        division.players_db.save()
+        division.responses.forget('player', ctx.author.id)
         await ctx.send(f"{ctx.author.mention}, you have been registered successfully.")
 
     @commands.command()
@@ -129,13 +279,21 @@ class Tournament(commands.Cog):
         """
         Changes your in-game nick that you have set during the registration."
         """
+        division = ctx.division
         try:
-            player = self.players_db.find_first("discord_id", ctx.author.id)
+            player = division.players_db.find_first("discord_id", ctx.author.id)
         except KeyError:
             await ctx.send(f'{ctx.author.mention}, you are not registered yet!')
             return True
-        player.ingame_name = new_name
-        self.players_db.save()
+        try:
+            player.ingame_name = new_name
+        except DuplicateKeyError:
+            await ctx.send(f'{ctx.author.mention}, the nick {new_name} is already used by another player.')
+            return True
+        division.players_db.save()
+        # the nick is on the player's answer and on their team's
+        division.responses.forget('player', ctx.author.id)
+        division.responses.forget('team', player.team)
         await ctx.send(f'{ctx.author.mention}, your ingame name has been change to {new_name} successfully.')
         return True
 
@@ -144,45 +302,56 @@ class Tournament(commands.Cog):
         """
         Mention a discord user in this command to see if he's registered and playing for any team.
         """
+        division = ctx.division
         try:
             user = await self.member_converter.convert(ctx, player_name)
         except commands.MemberNotFound:
             await ctx.send(f'{ctx.author.mention}, wrong argument. - this user has not been found.')
             return True
-        try:
-            player = self.players_db.find_first("discord_id", user.id)
-        except KeyError:
-            await ctx.send(f'{ctx.author.mention}, {user.mention} is not registered.')
-            return True
+        response = division.responses.get('player', user.id)
+        if response is None:
+            try:
+                player = division.players_db.find_first("discord_id", user.id)
+            except KeyError:
+                await ctx.send(f'{ctx.author.mention}, {user.mention} is not registered.')
+                return True
 
-        if player.team:
-            await ctx.send(f'{user.mention} *({player.ingame_name})* is currently playing with team {player.team}.')
-        else:
-            await ctx.send(f'{user.mention} *({player.ingame_name})* is currently not playing with any team.')
+            if player.team:
+                response = f'{user.mention} *({player.ingame_name})* is currently playing with team {player.team}.'
+            else:
+                response = f'{user.mention} *({player.ingame_name})* is currently not playing with any team.'
+            division.responses.put('player', user.id, response)
+        await ctx.send(response)
 
     @commands.group(aliases=['t'], invoke_without_command=True, ignore_extra=False)
     async def team(self, ctx, team_name):
         """
         Command group for calling team-related commands. Can be called by itself to show info about a team.
         """
+        division = ctx.division
         # check if they have mentioned the team role
         try:
             team_role = await commands.RoleConverter().convert(ctx, team_name)
             team_name = team_role.name
         except commands.RoleNotFound:
             pass
+        response = division.responses.get('team', team_name)
+        if response is not None:
+            await ctx.send(response)
+            return
         try:
-            _team = self.teams_db.find_first("name", team_name)
+            _team = division.teams_db.find_first("name", team_name)
             player_names = []
             for player_id in _team.players:
-                _p = self.players_db.find_first("discord_id", player_id)
+                _p = division.players_db.find_first("discord_id", player_id)
                 player_names.append((_p.name, _p.ingame_name))
-            captain = self.players_db.find_first("discord_id", _team.captain)
+            captain = division.players_db.find_first("discord_id", _team.captain)
             send_string = f"Team {_team.name}:\n" \
                           f"Players:\n"
             for player in player_names:
                 send_string += f"-> {player[0]} ({player[1]})\n"
             send_string += f'Captain: {captain.name} ({captain.ingame_name})'
+            division.responses.put('team', _team.name, send_string)
             await ctx.send(send_string)
         except KeyError:
             await ctx.send(f"Team {team_name} has not been found.")
@@ -192,8 +361,13 @@ class Tournament(commands.Cog):
         """
         Register a team for the tournament with you as player 1 and a captain. Usage: >team register "<team name>" @player2 @player3
         """
+        division = ctx.division
+        async with division.registration:
+            return await self._register_team(ctx, division, team_name, players)
+
+    async def _register_team(self, ctx, division, team_name, players):
         try:
-            self.teams_db.find_first('name', team_name)
+            division.teams_db.find_first('name', team_name)
             await ctx.send(f'Error in team registration: Team with name {team_name} already exists.')
             return True
         except KeyError:
@@ -204,12 +378,11 @@ class Tournament(commands.Cog):
         for name in players:
             try:
                 _p = await self.member_converter.convert(ctx, name)
-                _player = self.players_db.find_first("discord_id", _p.id)
+                _player = division.players_db.find_first("discord_id", _p.id)
                 if _player.team:
                     await ctx.send(f'Cannot register the team. {_p.mention} is already registered with team {_player.team}.')
                     return False
-                team_players.append(_p.id)
-                _player.team = team_name
+                team_players.append(_player)
             except commands.MemberNotFound:
                 await ctx.send(f"Error while parsing player names for team registration.")
                 return False
@@ -217,20 +390,37 @@ class Tournament(commands.Cog):
                 await ctx.send(f"Cannot register the team. {_p.mention} is not registered yet as a player.")
                 return False
         # Register the team on challonge
-        _team = Team(team_name, ctx.author.id, *team_players)
-        participant = challonge.participants.create(self.full_url, _team.name)
+        _team = Team(team_name, ctx.author.id, *[_player.discord_id for _player in team_players])
+        try:
+            participant = await division.bracket.create_participant(_team.name)
+        except ChallongeError as e:
+            await ctx.send(f"Cannot register the team on Challonge: {e}")
+            return False
         _team.challonge_id = participant["id"]
 
-        # Create a discord team role and assign it to the players.
-        team_discord_role = await ctx.guild.create_role(name=_team.name, mentionable=True, colour=discord.Colour.random(), reason=f'Role for the league team.')
-        _team.discord_role = team_discord_role.id
-        for player in [self.players_db.find_first("discord_id", player_id) for player_id in _team.players]:
-            discord_user = await self.member_converter.convert(ctx, player.name)
-            await discord_user.add_roles(team_discord_role, reason='Role for the league team.')
-
-        self.teams_db.db.append(_team)
-        self.teams_db.save()
-        self.players_db.save()
+        team_discord_role = None
+        try:
+            # Create a discord team role and assign it to the players.
+            team_discord_role = await ctx.guild.create_role(name=_team.name, mentionable=True, colour=discord.Colour.random(), reason=f'Role for the league team.')
+            _team.discord_role = team_discord_role.id
+            await self.team_roles.assign(ctx.guild, team_discord_role, [player.discord_id for player in team_players], reason='Role for the league team.')
+
+            # the team and all of its players are stored together, or not at all
+            with transaction(division.teams_db, division.players_db):
+                for player in team_players:
+                    player.team = team_name
+                division.teams_db.append(_team)
+        except BaseException as e:
+            # the databases have been rolled back, undo the rest too
+            if team_discord_role is not None:
+                await self.team_roles.delete([team_discord_role], reason='Team registration failed.')
+            await asyncio.gather(division.bracket.destroy_participant(participant["id"]), return_exceptions=True)
+            if isinstance(e, (discord.HTTPException, DuplicateKeyError)):
+                await ctx.send(f'Cannot register the team: {e}')
+                return False
+            raise
+        division.responses.forget('player', *[player.discord_id for player in team_players])
+        division.responses.forget('team', team_name)
         await ctx.send(f'Team {team_name} has been registered successfully.')
 
     @team.command(name='leave')
@@ -238,33 +428,46 @@ class Tournament(commands.Cog):
         """
         Leave the team you're currently registered with. If you are a captain, the team will be disbanded.
         """
+        division = ctx.division
         try:
-            _player = self.players_db.find_first("discord_id", ctx.author.id)
-            _team = self.teams_db.find_first("name", _player.team)
+            _player = division.players_db.find_first("discord_id", ctx.author.id)
+            _team = division.teams_db.find_first("name", _player.team)
         except KeyError:
             await ctx.send("Error while trying to leave a team.")
             return True
 
-        _player.team = None
-        _team.players.remove(_player.discord_id)
+        with transaction(division.teams_db, division.players_db):
+            _player.team = None
+            _team.players.remove(_player.discord_id)
+            team_players = [division.players_db.find_first("discord_id", _id) for _id in _team.players]
+            if _team.captain == _player.discord_id:
+                division.teams_db.remove(_team)
+                # Delete the team from everyone's profiles
+                for player in team_players:
+                    player.team = None
+        division.responses.forget('player', _player.discord_id, *[player.discord_id for player in team_players])
+        division.responses.forget('team', _team.name)
         if _team.captain == _player.discord_id:
-            self.teams_db.db.remove(_team)
-            # Remove the team from challonge
-            challonge.participants.destroy(self.full_url, _team.challonge_id)
-            # Delete the team from everyone's profiles
-            team_players = [self.players_db.find_first("discord_id", _id) for _id in _team.players]
-            for player in team_players:
-                player.team = None
-                d_user = await self.member_converter.convert(ctx, str(player.discord_id))
-                # Destroy the discord role
-                for role in d_user.roles:
-                    if role.id == _team.discord_role:
-                        await role.delete(reason="Team unregistered.")
+            error = await self.disband_team(ctx.guild, division, _team)
             await ctx.send(f"{ctx.author.mention}, as you were the captain of the team, the whole team {_team.name} has been disbanded.")
+            if error:
+                await ctx.send(error)
         else:
             await ctx.send(f"{ctx.author.mention}, you have left team {_team.name} successfully.")
-        self.players_db.save()
-        self.teams_db.save()
+
+    async def disband_team(self, guild, division, team):
+        """
+        Removes a team that's gone from the databases from challonge and discord. Returns what went wrong with challonge,
+        if anything - the role goes either way.
+        """
+        error = None
+        try:
+            await division.bracket.destroy_participant(team.challonge_id)
+        except (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning(f'Removing the team {team.name} (participant {team.challonge_id}) from {division.name} on challonge failed: {e}')
+            error = f'Removing the team {team.name} from Challonge failed, an admin has to remove it there: {e or type(e).__name__}'
+        await self.team_roles.disband(guild, team.discord_role, reason="Team unregistered.")
+        return error
 
     @team.command(name='add')
     @commands.check(is_captain)
@@ -272,9 +475,10 @@ class Tournament(commands.Cog):
         """
         Join the specified team.
         """
+        division = ctx.division
         try:
             d_user = await self.member_converter.convert(ctx, player_name)
-            player = self.players_db.find_first("discord_id", d_user.id)
+            player = division.players_db.find_first("discord_id", d_user.id)
         except commands.MemberNotFound:
             await ctx.send(f"{ctx.author.mention}, discord user {player_name} not found.")
             return False
@@ -282,126 +486,146 @@ class Tournament(commands.Cog):
             await ctx.send(f"{ctx.author.mention}, {d_user.mention} has not registered yet.")
             return False
 
-        captain = self.players_db.find_first("discord_id", ctx.author.id)
-        team = self.teams_db.find_first("name", captain.team)
-        team.players.add(player.discord_id)
-        player.team = team.name
+        # not while a registration that has checked the player is waiting for challonge
+        async with division.registration:
+            captain = division.players_db.find_first("discord_id", ctx.author.id)
+            team = division.teams_db.find_first("name", captain.team)
+            with transaction(division.teams_db, division.players_db):
+                team.players.add(player.discord_id)
+                player.team = team.name
+        division.responses.forget('player', player.discord_id)
+        division.responses.forget('team', team.name)
 
         await ctx.send(f"{ctx.author.mention}, {d_user.mention} *({player.ingame_name})* has been added to your team.")
-        self.players_db.save()
-        self.teams_db.save()
         return True
 
     @tasks.loop(hours=1)
     async def get_played_matches(self):
-        # what matches are we looking for (with in-game nicknames)
-        _participants_ids_to_names = {p['participant']['id']: p['participant']['name'] for p in self.challonge_tournament['participants']}
-        _scheduled_matches_as_ids = [(match['match']['player1_id'], match['match']['player2_id']) for match in self.challonge_tournament['matches']]
-        # [((team1_name, team1_challonge_id), (team2_name, team2_challonge_id)), (different two teams), ...]
-        _scheduled_matches = [((_participants_ids_to_names[p1_id], p1_id), (_participants_ids_to_names[p2_id], p2_id)) for p1_id, p2_id in _scheduled_matches_as_ids]
-        # get in-game nicks of registered teams
-        # frozenset is set, but can't be changed (immutable) and thus can be used as a dict key (a.k.a is hashable - list isn't)
-        ingame_nicks = {frozenset([self.players_db.find_first("discord_id", discord_id).ingame_name for discord_id in team.players]): team.name for team in self.teams_db.db}
-        # load played matches
-        _matches = json.loads(requests.get("http://mww.sonicrat.org/api/").text)
-        # dict {[frozenset of tuples of player (nicks, teamID) that have played]: match}
-        player_nicks = {frozenset([(player['Name'], player['TeamID']) for player in match['players']]): match for match in _matches}
-        # MATCH PARSING
-        # take one match
-        print(f'Parsing matches.')
-        team1, team2 = None, None
-        for players_in_a_match, match in player_nicks.items():
-            # first check the mode
-            if match['mode'] != 'melee':
-                continue
-            # go through each player in the match (MWW)
-            for nick, teamID in players_in_a_match:
-                # if it's the first one, find out if they're registered for the tournament
-                if (team1 and team2) is None:
-                    print(f'Parsing first team')
-                    for nick_list in ingame_nicks:
-                        if nick in nick_list:
-                            # if we find the team player is registered with, all other nick in the match have to belong either to that team
-                            #   or to the one they are playing against (pulled from challonge).
-                            # Try and get the nick list for the second team in the scheduled match
-                            for _team1, _team2 in _scheduled_matches:
-                                if _team1[0] == ingame_nicks[nick_list]:
-                                    print(f'found team 1: ', _team1[0])
-                                    for nick_list_2, _team in ingame_nicks.items():
-                                        if _team == _team2[0]:
-                                            print('found team 2: ', _team2[0])
-                                            # We found the scheduled match and have lists of nicks in both teams
-                                            # (team_name, team_challonge_id, MWW_match_team_ID, {set of player nicks})
-                                            team1 = (_team1[0], _team1[1], teamID, nick_list)
-                                            if team1[2] == 1:       # pokud v MWW je team1 == 1, tak team2 = 2; jinak 1
-                                                team2 = (_team2[0], _team2[1], 2, nick_list_2)
-                                            elif team1[2] == 2:
-                                                team2 = (_team2[0], _team2[1], 1, nick_list_2)
-                                            break
-                                    break
-                            break
-                    # if it was the first one and we already did not get any results from the parsing above (e.g. player not registered), we are done
-                    if (team1 and team2) is None:
-                        team1, team2 = None, None
-                        break
-                # if they are not the first player that's being parsed, then they have to belong to one of the teams.
-                else:
-                    print(f'Parsing another player.')
-                    if teamID == team1[2]:
-                        if nick in team1[3]:
-                            continue
-                    elif nick in team2[3]:
-                        continue
-                    # if not, we move on to the next team
-                    elif not (nick in team1[3] or nick in team2[3]):
-                        print(f'Failed!')
-                        team1, team2 = None, None
-                        break
-            # if at some point the asserts were broken, then go to next team
-            if (team1 and team2) is None:
-                continue
+        try:
+            with metrics.MATCH_PARSING_SECONDS.time():
+                await self.parse_played_matches()
+        except Exception:
+            # the next run picks up from the same watermark
+            log.error('Parsing the played matches failed:', exc_info=True)
 
-            # If we get here, then the match is the one played for the league
-            # Check the winner
-            print('Found the match!')
-            if match['winner'] == team1[2]:
-                winner = team1
-                print(f'Winner: {team1[0]}')
-            elif match['winner'] == team2[2]:
-                winner = team2
-                print(f'Winner: {team2[0]}')
-            else:
-                # if the match has been ended before finished, there's no winner
+    async def parse_played_matches(self, stopwatch=None):
+        """
+        Goes through the new MWW matches once for all the divisions. Returns {division name: [MatchResult]}.
+        """
+        await self.wait_until_ready()
+        if stopwatch is None:
+            stopwatch = metrics.Stopwatch()
+        # the hourly run, >admin parse and >admin timeparse wait for each other
+        with stopwatch.stage('wait'):
+            await self.parsing.acquire()
+        try:
+            return await self._parse_played_matches(stopwatch)
+        finally:
+            self.parsing.release()
+
+    async def _parse_played_matches(self, stopwatch):
+        divisions = list(self.divisions.values())
+        with stopwatch.stage('bracket'):
+            tournament_states = await asyncio.gather(*[division.bracket.get() for division in divisions], return_exceptions=True)
+        for i, (division, tournament_state) in enumerate(zip(divisions, tournament_states)):
+            if not isinstance(tournament_state, Exception):
                 continue
-            # Set the challonge match
-            # We need a challonge match ID for that!
-            # use _participant_names_to_IDs to code team names back to their challonge IDs then find the match with both of them.
-            _team1_id, _team2_id = None, None
-            for _id, _team_name in _participants_ids_to_names.items():
-                if _team_name == team1[0]:
-                    _team1_id = _id
-                elif _team_name == team2[0]:
-                    _team2_id = _id
-            print(f'Challonge IDs of teams: {_team1_id}, {_team2_id}')
-            for _challonge_match in self.challonge_tournament['matches']:
-                print(f'Looking for the match between those.')
-                if (_challonge_match['match']['player1_id'] == _team1_id or _challonge_match['match']['player1_id'] == _team2_id) and \
-                   (_challonge_match['match']['player2_id'] == _team1_id or _challonge_match['match']['player2_id'] == _team2_id):
-                    print(f'Found the match, trying to update...')
-                    challonge.matches.update(self.full_url, _challonge_match['match']['id'], scores_csv='1-1', winner_id=str(winner[1]))
+            # the teams and matches hardly change, the last known bracket is good enough to find the results with
+            if not isinstance(tournament_state, (ChallongeError, aiohttp.ClientError, asyncio.TimeoutError)) or division.bracket.state is None:
+                raise tournament_state
+            log.warning(f'Refreshing the challonge tournament {division.name} failed, using the last known bracket: {tournament_state}')
+            tournament_states[i] = division.bracket.state
+        with stopwatch.stage('index'):
+            engines = [MatchEngine.from_databases(division.teams_db, division.players_db, tournament_state)
+                       for division, tournament_state in zip(divisions, tournament_states)]
+        results = {}
+        for division, engine in zip(divisions, engines):
+            log.info(f'Parsing matches of {division.name} after {division.ingest_state.watermark}.')
+            division.ingest_state.start()
+            # games played before challonge had a match for them, e.g. before the pairing opened
+            with stopwatch.stage('index'):
+                results[division.name] = division.ingest_state.retry_waiting(engine)
+        watermarks = [division.ingest_state.watermark for division in divisions]
+        matches = JsonListStream()
+        run_id = time.monotonic_ns()
+
+        # the feed is decoded and matched in the worker process, piece by piece as it downloads - the engines only go
+        # with the first piece and only the league matches come back
+        async def classify(data, final=False):
+            nonlocal matches, engines
+            matches, batch_results, highest, waiting = await workers.run_in_process(classify_batch, run_id, engines, watermarks,
+                                                                                    matches, data, final)
+            engines = None
+            for division, division_results, match_id, division_waiting in zip(divisions, batch_results, highest, waiting):
+                division.ingest_state.advance(match_id)
+                division.ingest_state.wait(division_waiting)
+                results[division.name].extend(result for result in division_results if not division.ingest_state.is_reported(result))
+
+        # fetch is the time spent waiting for sonicrat, decode/match the time spent waiting for the worker
+        batches = self.match_feed.batches()
+        try:
+            while True:
+                with stopwatch.stage('fetch'):
+                    try:
+                        data = await batches.__anext__()
+                    except StopAsyncIteration:
+                        break
+                with stopwatch.stage('decode/match'):
+                    await classify(data)
+        finally:
+            await batches.aclose()
+        with stopwatch.stage('decode/match'):
+            await classify(b'', final=True)
+        with stopwatch.stage('queue'):
+            # the results are saved to the outbox before the watermark moves past them, challonge gets them from there
+            for division in divisions:
+                for result in results[division.name]:
+                    log.info(f'Found the match {result.winner} vs. {result.loser}, winner: {result.winner}. Queueing challonge match {result.challonge_match_id}.')
+                    division.ingest_state.mark_reported(result)
+                metrics.MATCHES_FOUND.inc(division.outbox.add(results[division.name]))
+                division.ingest_state.commit()
+        # don't wait for the next round of the delivery task
+        if any(results.values()):
+            asyncio.ensure_future(self.deliver_results())
+        return results
 
     @commands.command(name="listplayers")
-    async def list_players(self, ctx):
+    async def list_players(self, ctx, *, team_name=None):
         """
-        List all of the registered players along with their teams, if they are in one.
+        List all of the registered players along with their teams, if they are in one. Usage: >listplayers [team name | unteamed]
         """
-        send_string = f"Registered players:"
-        for player in self.players_db.db:
-            d_user = await self.member_converter.convert(ctx, str(player.discord_id))
-            send_string += f"\n{self._get_discord_nick(ctx, user=d_user)} ({player.ingame_name})"
+        division = ctx.division
+        players = division.players_db.db
+        if team_name == 'unteamed':
+            players = [player for player in players if not player.team]
+        elif team_name:
+            players = [player for player in players if player.team == team_name]
+        members = await get_members(ctx.guild, [player.discord_id for player in players])
+
+        lines = []
+        for player in players:
+            d_user = members.get(player.discord_id)
+            # players who have left the server are listed under the name they registered with
+            line = f"{self._get_discord_nick(ctx, user=d_user) if d_user else player.name} ({player.ingame_name})"
             if player.team:
-                send_string += f" - team {player.team}"
-        await ctx.send(send_string)
+                line += f" - team {player.team}"
+            lines.append(line)
+        for page in self._paginate("Registered players:", lines):
+            await ctx.send(page)
+
+    @staticmethod
+    def _paginate(header, lines, limit=2000):
+        """
+        Splits the lines into messages that fit into discord's message length limit.
+        """
+        page = header
+        for line in lines:
+            if len(page) + len(line) + 1 > limit:
+                yield page
+                page = line
+            else:
+                page += f"\n{line}"
+        yield page
 
 
 # BETTING IS NOT UPDATED, DONT USE
@@ -486,29 +710,9 @@ class Betting(commands.Cog):
         return self.betters[_id]
 
 
-class Player:
-    def __init__(self, name, ingame_name=None, team=None, discord_id=None):
-        self.name = name
-        self.ingame_name = ingame_name
-        self.team = team
-        self.discord_id = discord_id
-
-
-class Team:
-    def __init__(self, name, captain, *args, challonge_id=None, discord_role=None):
-        self.name = name
-        self.captain = captain
-        self.players = set()
-        for person in args:
-            self.players.add(person)
-        self.players.add(captain)
-        self.challonge_id = challonge_id
-        self.discord_role = discord_role
-
-
 # Extension thingie
 def setup(bot):
-    tournament = Tournament(bot.tournament_id, bot.challonge_api_token)
+    tournament = Tournament(bot.tournaments, bot.challonge, bot.match_feed)
     bot.add_cog(tournament)
     # Betting not used at the moment
     # bot.add_cog(tournament.betting)
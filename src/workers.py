@@ -0,0 +1,72 @@
+"""
+Where the work that would stall the event loop goes: CPU heavy parsing to a worker process, blocking disk writes to a
+writer thread. Only snapshots that nothing else changes are handed over, the results are merged back on the loop.
+Until start() is called everything runs inline, the way the benchmarks and scripts want it.
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+enabled = False
+_processes = None
+_writer = None
+
+
+def start():
+    global enabled, _processes, _writer
+    enabled = True
+    # one process, which keeps the state of the parsing run it's in between the pieces of the feed.
+    # It's forked, not spawned - a spawned process would import main.py and start another bot
+    _processes = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'))
+    # a single thread, so the writes land on the disk in the order they were made
+    _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk-writer')
+
+
+def stop():
+    """
+    Waits for the queued writes to finish and shuts the workers down.
+    """
+    global enabled, _processes, _writer
+    if not enabled:
+        return
+    enabled = False
+    _writer.shutdown(wait=True)
+    _processes.shutdown(wait=False)
+    _writer = _processes = None
+
+
+async def run_in_process(function, *args):
+    """
+    Runs function(*args) in the worker process. The arguments and the result are pickled on the way.
+    """
+    if not enabled:
+        return function(*args)
+    return await asyncio.get_event_loop().run_in_executor(_processes, function, *args)
+
+
+def write(function, *args):
+    """
+    Queues function(*args) on the writer thread and returns straight away. Failures are logged.
+    """
+    if not enabled:
+        function(*args)
+        return
+    _writer.submit(function, *args).add_done_callback(_log_failure)
+
+
+async def run_after_writes(function, *args):
+    """
+    Runs function(*args) on the writer thread, behind the writes queued so far, and waits for the result.
+    For reading files that may still have writes on the way.
+    """
+    if not enabled:
+        return function(*args)
+    return await asyncio.wrap_future(_writer.submit(function, *args))
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        log.error('Writing to the disk failed:', exc_info=future.exception())
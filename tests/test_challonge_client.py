@@ -0,0 +1,143 @@
+import asyncio
+from email.utils import formatdate
+import os
+import sys
+import time
+import unittest
+
+import aiohttp
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, 'src'))
+sys.path.insert(0, os.path.join(root, 'benchmarks'))
+
+from challonge_client import ChallongeClient, ChallongeError
+from fakes import FakeChallonge, Services
+
+
+# aiohttp 3.7 on python 3.11+ reports a timeout as ClientOSError, TimeoutError being an OSError there
+TIMEOUT = (asyncio.TimeoutError, aiohttp.ClientOSError)
+
+
+class ChallongeClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.challonge = FakeChallonge()
+        self.challonge.add_tournament('league')
+        self.services = Services()
+        self.url = self.services.serve(self.challonge.app())
+        self.client = self.make_client()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.services.stop()
+
+    def make_client(self, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        return ChallongeClient('user', 'key', base_url=f'{self.url}/v1/', **kwargs)
+
+    def fail(self, status, times=1, headers=None):
+        self.services.call(self.challonge.fail, status, times, headers)
+
+    def count(self, method, route='/v1/tournaments/{tournament}.json'):
+        return self.challonge.requests.get((method, route), 0)
+
+    async def test_retries_429_and_5xx(self):
+        for status in (429, 500, 503):
+            with self.subTest(status=status):
+                self.challonge.requests.clear()
+                self.fail(status, times=2)
+                tournament = await self.client.show_tournament('league')
+                self.assertEqual(tournament['url'], 'league')
+                self.assertEqual(self.count('GET'), 3)
+
+    async def test_gives_up_after_the_retries(self):
+        self.fail(503, times=10)
+        with self.assertRaises(ChallongeError) as raised:
+            await self.client.show_tournament('league')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(self.count('GET'), self.client.retries + 1)
+
+    async def test_client_errors_are_not_retried(self):
+        with self.assertRaises(ChallongeError) as raised:
+            await self.client.show_tournament('nope')
+        self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(raised.exception.errors, ['Not found'])
+        self.assertEqual(self.count('GET'), 1)
+
+    async def assert_waits(self, retry_after, low, high):
+        # the backoff alone would be a minute, so finishing in time means Retry-After was followed
+        await self.client.close()
+        self.client = self.make_client(backoff=60)
+        self.fail(429, headers={'Retry-After': retry_after})
+        start = time.perf_counter()
+        await self.client.show_tournament('league')
+        self.assertGreaterEqual(time.perf_counter() - start, low)
+        self.assertLess(time.perf_counter() - start, high)
+
+    async def test_retry_after_seconds(self):
+        await self.assert_waits('0.3', 0.3, 5)
+
+    async def test_retry_after_http_date(self):
+        await self.assert_waits(formatdate(time.time() + 2, usegmt=True), 0.5, 5)
+        await self.assert_waits(formatdate(time.time() - 60, usegmt=True), 0, 5)
+
+    async def test_bad_retry_after_falls_back_to_the_backoff(self):
+        self.fail(429, headers={'Retry-After': 'soon'})
+        await self.client.show_tournament('league')
+        self.assertEqual(self.count('GET'), 2)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(ChallongeClient._retry_after('7'), 7)
+        self.assertEqual(ChallongeClient._retry_after('-1'), 0)
+        self.assertEqual(ChallongeClient._retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertAlmostEqual(ChallongeClient._retry_after(formatdate(time.time() + 100, usegmt=True)), 100, delta=2)
+        for value in (None, '', 'nan', 'inf', 'soon'):
+            self.assertIsNone(ChallongeClient._retry_after(value))
+
+    async def test_post_is_not_retried_on_5xx(self):
+        self.fail(503)
+        with self.assertRaises(ChallongeError) as raised:
+            await self.client.create_participant('league', 'A')
+        self.assertEqual(raised.exception.status, 503)
+        self.assertEqual(self.count('POST', '/v1/tournaments/{tournament}/participants.json'), 1)
+        self.assertEqual(self.challonge.tournaments['league']['participants'], [])
+
+    async def test_post_is_retried_on_429(self):
+        self.fail(429)
+        await self.client.create_participant('league', 'A')
+        self.assertEqual(self.count('POST', '/v1/tournaments/{tournament}/participants.json'), 2)
+        self.assertEqual(len(self.challonge.tournaments['league']['participants']), 1)
+
+    async def test_post_is_not_retried_on_timeout(self):
+        await self.client.close()
+        self.client = self.make_client(timeout=0.2)
+        self.challonge.latency = 0.5
+        with self.assertRaises(TIMEOUT):
+            await self.client.create_participant('league', 'A')
+        self.assertEqual(self.count('POST', '/v1/tournaments/{tournament}/participants.json'), 1)
+
+    async def test_get_is_retried_on_timeout(self):
+        await self.client.close()
+        self.client = self.make_client(timeout=0.2, retries=1)
+        self.challonge.latency = 0.5
+        with self.assertRaises(TIMEOUT):
+            await self.client.show_tournament('league')
+        self.assertEqual(self.count('GET'), 2)
+
+    async def test_unwrap(self):
+        participant = await self.client.create_participant('league', 'A')
+        self.assertEqual(participant['name'], 'A')
+        participants = await self.client.bulk_add_participants('league', ['B', 'C'])
+        self.assertEqual([participant['name'] for participant in participants], ['B', 'C'])
+        tournament = await self.client.show_tournament('league', include_participants=1)
+        self.assertEqual(len(tournament['participants']), 3)
+        self.assertEqual(ChallongeClient._unwrap({'match': {'id': 1}}), {'id': 1})
+        self.assertEqual(ChallongeClient._unwrap([{'match': {'id': 1}}, {'match': {'id': 2}}]), [{'id': 1}, {'id': 2}])
+        # anything that isn't a single wrapped object is left alone
+        self.assertEqual(ChallongeClient._unwrap({'id': 1, 'name': 'A'}), {'id': 1, 'name': 'A'})
+        self.assertEqual(ChallongeClient._unwrap({'errors': ['x']}), {'errors': ['x']})
+        self.assertEqual(ChallongeClient._unwrap([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
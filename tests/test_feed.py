@@ -0,0 +1,96 @@
+import json
+import os
+import pickle
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from feed import JsonListStream
+
+DOCUMENTS = [
+    [],
+    [1],
+    [12345, -0.5, 1.25e-3, 6E+2, 0, -17],
+    [True, False, None, 'x', [], {}, [[1, [2]], {'a': [3]}]],
+    [{'id': 1, 'Name': 'a], b, "c"', 'path': 'C:\\\\dir\\\\', 'tab': '\t', 'nick': 'wizard ]['},
+     {'id': 2, 'unicode': 'čšř 魔法 🧙', 'quoted': 'say "hi" ] \\" ,', 'list': '[1, 2]', 'obj': '{"x": 1}'}],
+    [{'id': i, 'mode': 'melee', 'winner': i % 3, 'players': [{'Name': f'p{i}]', 'TeamID': 1}, {'Name': f'q,{i}', 'TeamID': 2}]}
+     for i in range(50)],
+]
+
+
+def split(data, rng, pieces):
+    cuts = sorted(rng.randrange(len(data) + 1) for _ in range(pieces))
+    return [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+
+
+class JsonListStreamTest(unittest.TestCase):
+    def decode(self, chunks, repickle=False):
+        stream = JsonListStream()
+        items = []
+        for chunk in chunks:
+            if repickle:
+                # the way it travels to the worker process and back between the pieces of the feed
+                stream = pickle.loads(pickle.dumps(stream))
+            items.extend(stream.feed(chunk))
+        if repickle:
+            stream = pickle.loads(pickle.dumps(stream))
+        items.extend(stream.feed(b'', final=True))
+        return items
+
+    def encodings(self, document):
+        yield json.dumps(document).encode()
+        yield json.dumps(document, ensure_ascii=False).encode()
+        yield json.dumps(document, indent=2, separators=(' , ', ' : ')).encode()
+
+    def test_whole(self):
+        for document in DOCUMENTS:
+            for data in self.encodings(document):
+                self.assertEqual(self.decode([data]), document)
+
+    def test_every_split(self):
+        for document in DOCUMENTS[:5]:
+            for data in self.encodings(document):
+                for cut in range(len(data) + 1):
+                    self.assertEqual(self.decode([data[:cut], data[cut:]]), document, (data, cut))
+
+    def test_random_splits(self):
+        rng = random.Random(0)
+        for document in DOCUMENTS:
+            for data in self.encodings(document):
+                for _ in range(50):
+                    chunks = split(data, rng, rng.randint(1, 30))
+                    self.assertEqual(self.decode(chunks, repickle=rng.random() < 0.5), document)
+
+    def test_byte_by_byte(self):
+        for document in DOCUMENTS:
+            data = json.dumps(document, ensure_ascii=False).encode()
+            self.assertEqual(self.decode([data[i:i + 1] for i in range(len(data))], repickle=True), document)
+
+    def test_numbers_split_across_chunks(self):
+        for chunks, expected in ((['[12', '3]'], [123]), (['[1', '.5e3]'], [1500.0]), (['[-', '4, 5]'], [-4, 5]),
+                                 (['[1.5e', '-2]'], [0.015]), (['[tr', 'ue, nul', 'l]'], [True, None])):
+            self.assertEqual(self.decode([chunk.encode() for chunk in chunks]), expected)
+
+    def test_items_come_out_as_soon_as_complete(self):
+        stream = JsonListStream()
+        self.assertEqual(stream.feed(b'[{"id": 1}, {"id"'), [{'id': 1}])
+        self.assertEqual(stream.feed(b': 2}, 3'), [{'id': 2}])
+        # 3 could still become 34
+        self.assertEqual(stream.feed(b'4]'), [34])
+        self.assertEqual(stream.feed(b'', final=True), [])
+
+    def test_bad_input(self):
+        for data in (b'', b'[', b'[1', b'[1,]', b'[,1]', b'[1 2]', b'[1]x', b'[1]]', b'{}', b'1', b'["abc',
+                     b'[{"a": 1]', b'[1,,2]', b'[nope]', b'\xff[1]'):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    self.decode([data])
+                with self.assertRaises(ValueError):
+                    self.decode([data[i:i + 1] for i in range(len(data))], repickle=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
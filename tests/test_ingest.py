@@ -0,0 +1,110 @@
+"""
+Run from the repository root: python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('TESTING', '1')
+os.environ.setdefault('REGISTRATION_OPEN', '1')
+
+from storage import JsonDB, Player, Team
+import tournament
+import workers
+
+
+class FakeChallonge:
+    def __init__(self, matches):
+        self.participants = [{'participant': {'id': 100 + i, 'name': name}} for i, name in enumerate('ABC')]
+        self.matches = matches
+
+    async def show_tournament(self, tournament_id, **params):
+        return {'id': 1, 'url': tournament_id, 'updated_at': str(len(self.matches)), 'participants': self.participants,
+                'matches': [{'match': dict(match)} for match in self.matches]}
+
+    async def update_match(self, tournament_id, match_id, **fields):
+        return {}
+
+
+class FakeFeed:
+    def __init__(self):
+        self.history = []
+
+    async def batches(self):
+        # in two pieces, so that overlapping runs would interleave
+        data = json.dumps(self.history).encode()
+        yield data[:len(data) // 2]
+        await asyncio.sleep(0.01)
+        yield data[len(data) // 2:]
+
+
+def game(match_id, winner, loser):
+    return {'id': match_id, 'mode': 'melee', 'winner': 1,
+            'players': [{'Name': f'{winner.lower()}1', 'TeamID': 1}, {'Name': f'{loser.lower()}1', 'TeamID': 2}]}
+
+
+class ParsePlayedMatchesTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        players = [Player(name, ingame_name=f'{name.lower()}1', discord_id=i, team=name) for i, name in enumerate('ABC')]
+        teams = [Team(name, i, challonge_id=100 + i, discord_role=200 + i) for i, name in enumerate('ABC')]
+        JsonDB._write_atomic('playersDB.json', players)
+        JsonDB._write_atomic('teamsDB.json', teams)
+        self.challonge = FakeChallonge([{'id': 1, 'state': 'open', 'player1_id': 100, 'player2_id': 101}])
+        self.feed = FakeFeed()
+        self.cog = tournament.Tournament({'league': {'challonge_id': 'league', 'prefix': ''}}, self.challonge, self.feed)
+        await self.cog.wait_until_ready()
+        self.division = self.cog.divisions['league']
+
+    async def asyncTearDown(self):
+        self.cog.cog_unload()
+        workers.stop()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    async def parse(self):
+        self.division.bracket.invalidate()
+        results = await self.cog.parse_played_matches()
+        return [(result.winner, result.loser) for result in results['league']]
+
+    async def test_pairing_opened_after_the_game(self):
+        self.feed.history = [game(1, 'A', 'B'), game(2, 'A', 'C')]
+        self.assertEqual(await self.parse(), [('A', 'B')])
+        # A-C gets its challonge match once the next round opens
+        self.challonge.matches.append({'id': 2, 'state': 'open', 'player1_id': 100, 'player2_id': 102})
+        self.assertEqual(await self.parse(), [('A', 'C')])
+        self.assertEqual(await self.parse(), [])
+        self.assertEqual(self.division.ingest_state.waiting, {})
+
+    async def test_waiting_games_survive_a_restart(self):
+        self.feed.history = [game(1, 'A', 'C')]
+        self.assertEqual(await self.parse(), [])
+        self.challonge.matches.append({'id': 2, 'state': 'open', 'player1_id': 100, 'player2_id': 102})
+        self.cog.cog_unload()
+        self.cog = tournament.Tournament({'league': {'challonge_id': 'league', 'prefix': ''}}, self.challonge, self.feed)
+        await self.cog.wait_until_ready()
+        self.division = self.cog.divisions['league']
+        self.assertEqual(await self.parse(), [('A', 'C')])
+
+    async def test_other_games_are_not_kept(self):
+        self.feed.history = [game(1, 'A', 'B'), {'id': 2, 'mode': 'melee', 'winner': 1,
+                                                 'players': [{'Name': 'a1', 'TeamID': 1}, {'Name': 'pug', 'TeamID': 2}]}]
+        self.assertEqual(await self.parse(), [('A', 'B')])
+        self.assertEqual(self.division.ingest_state.waiting, {})
+
+    async def test_overlapping_runs(self):
+        workers.start()
+        self.feed.history = [game(1, 'A', 'B'), game(2, 'A', 'C')]
+        first, second = await asyncio.gather(self.cog.parse_played_matches(), self.cog.parse_played_matches())
+        self.assertEqual([(result.winner, result.loser) for result in first['league'] + second['league']], [('A', 'B')])
+        self.assertEqual(self.division.ingest_state.watermark, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
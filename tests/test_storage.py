@@ -0,0 +1,174 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from storage import DuplicateKeyError, JsonDB, Player, Team, open_db, transaction
+import workers
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        workers.stop()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def open(self, journal):
+        teams = JsonDB('teamsDB', ('name',), journal=journal)
+        players = JsonDB('playersDB', ('discord_id', 'name', 'ingame_name'), journal=journal)
+        return teams, players
+
+    def fill(self, teams, players):
+        with transaction(teams, players):
+            for i in range(4):
+                players.append(Player(f'p{i}', ingame_name=f'n{i}', discord_id=i, team='A' if i < 2 else None))
+            teams.append(Team('A', 0, 1, challonge_id=10))
+
+    def snapshot(self, teams, players):
+        return ([JsonDB._encoder(team) for team in teams.db], [JsonDB._encoder(player) for player in players.db],
+                {attr: sorted(index) for attr, index in players.indexes.items()} if isinstance(players, JsonDB) else None)
+
+    def check_rollback(self, journal):
+        teams, players = self.open(journal)
+        self.fill(teams, players)
+        before = self.snapshot(teams, players)
+        with self.assertRaises(DuplicateKeyError):
+            with transaction(teams, players):
+                team = teams.find_first('name', 'A')
+                players.remove(players.find_first('discord_id', 1))
+                team.players.remove(1)
+                player = players.find_first('discord_id', 2)
+                player.team = 'A'
+                player.ingame_name = 'renamed'
+                team.players.add(2)
+                players.append(Player('p9', ingame_name='n9', discord_id=9))
+                teams.append(Team('A', 3))
+        self.assertEqual(self.snapshot(teams, players), before)
+        self.assertIs(players.find_first('ingame_name', 'n2'), players.find_first('discord_id', 2))
+        with self.assertRaises(KeyError):
+            players.find_first('discord_id', 9)
+        # and the same is what's on the disk after the next save
+        with transaction(teams, players):
+            players.find_first('discord_id', 3).team = 'A'
+            teams.find_first('name', 'A').players.add(3)
+        expected = self.snapshot(teams, players)
+        workers.stop()
+        self.assertEqual(self.snapshot(*self.open(journal)), expected)
+
+    def test_rollback_clear(self):
+        for journal in (False, True):
+            teams, players = self.open(journal)
+            if not teams.db:
+                self.fill(teams, players)
+            before = self.snapshot(teams, players)
+            with self.assertRaises(RuntimeError):
+                with transaction(teams, players):
+                    teams.clear()
+                    players.clear()
+                    players.append(Player('p9', discord_id=9))
+                    raise RuntimeError()
+            self.assertEqual(self.snapshot(teams, players), before)
+            players.save()
+            teams.save()
+            workers.stop()
+            self.assertEqual(self.snapshot(*self.open(journal)), before)
+
+    def test_rollback(self):
+        self.check_rollback(journal=False)
+
+    def test_rollback_journal(self):
+        self.check_rollback(journal=True)
+
+    def test_rollback_with_writes_queued(self):
+        workers.start()
+        self.check_rollback(journal=True)
+
+    def test_rejected_key_change(self):
+        teams, players = self.open(journal=True)
+        self.fill(teams, players)
+        player = players.find_first('discord_id', 2)
+        with self.assertRaises(DuplicateKeyError):
+            player.discord_id = 3
+        players.save()
+        workers.stop()
+        self.assertEqual(JsonDB._encoder(self.open(journal=True)[1].find_first('discord_id', 2)), JsonDB._encoder(player))
+
+    def test_sqlite_rollback_keeps_the_other_records(self):
+        sqlite_file = os.path.join(self.directory.name, 'lenny.sqlite3')
+        teams = open_db('teamsDB', ('name',), backend='sqlite', sqlite_file=sqlite_file)
+        players = open_db('playersDB', ('discord_id', 'name', 'ingame_name'), backend='sqlite', sqlite_file=sqlite_file)
+        self.addCleanup(teams.connection.close)
+        self.fill(teams, players)
+        team = teams.find_first('name', 'A')
+        removed = players.find_first('discord_id', 1)
+        changed = players.find_first('discord_id', 2)
+        # held by another command meanwhile
+        other = players.find_first('discord_id', 3)
+        before = self.snapshot(teams, players)
+        added = Player('p9', ingame_name='n9', discord_id=9)
+        with self.assertRaises(DuplicateKeyError):
+            with transaction(teams, players):
+                players.remove(removed)
+                team.players.remove(1)
+                changed.team = 'A'
+                changed.discord_id = 20
+                team.players.add(20)
+                players.append(added)
+                teams.append(Team('A', 3))
+        self.assertEqual(self.snapshot(teams, players), before)
+        # the same objects stand for the same rows again, with what's in them
+        self.assertIs(players.find_first('discord_id', 1), removed)
+        self.assertIs(players.find_first('discord_id', 2), changed)
+        self.assertIsNone(changed.team)
+        self.assertIs(teams.find_first('name', 'A'), team)
+        self.assertEqual(team.players, {0, 1})
+        self.assertIsNone(added._db)
+        with self.assertRaises(KeyError):
+            players.find_first('discord_id', 9)
+        # and the changes of the other command still get stored
+        with transaction(teams, players):
+            other.team = 'A'
+            team.players.add(3)
+        self.assertIs(players.find_first('discord_id', 3), other)
+        players._records.clear()
+        teams._records.clear()
+        self.assertEqual(players.find_first('discord_id', 3).team, 'A')
+        self.assertEqual(teams.find_first('name', 'A').players, {0, 1, 3})
+
+    def test_every_change_of_a_team_is_tracked(self):
+        changes = [lambda players: players.update({5, 6}), lambda players: players.difference_update({5}),
+                   lambda players: players.intersection_update({0, 6}), lambda players: players.symmetric_difference_update({7}),
+                   lambda players: players.pop(), lambda players: players.clear(), lambda players: players.add(8)]
+        for operator in ('__ior__', '__isub__', '__iand__', '__ixor__'):
+            changes.append(lambda players, operator=operator: getattr(players, operator)({0, 9}))
+        for journal in (False, True):
+            for change in changes:
+                with self.subTest(journal=journal, change=change):
+                    teams, players = self.open(journal)
+                    if not teams.db:
+                        self.fill(teams, players)
+                    team = teams.find_first('name', 'A')
+                    before = set(team.players)
+                    # undone with the rest of a failed transaction
+                    with self.assertRaises(DuplicateKeyError):
+                        with transaction(teams, players):
+                            change(team.players)
+                            teams.append(Team('A', 3))
+                    self.assertEqual(team.players, before)
+                    # and saved by a successful one
+                    with transaction(teams, players):
+                        change(team.players)
+                    # loading always puts the captain back in
+                    expected = team.players | {team.captain}
+                    self.assertEqual(self.open(journal)[0].find_first('name', 'A').players, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()